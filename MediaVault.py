@@ -1,556 +1,3814 @@
-import argparse
-import csv
-import logging
-import os
-import re
-import sys
-import shutil
-from abc import ABC, abstractmethod
-from datetime import datetime, timedelta      # utils date
-from enum import Enum
-from hachoir.parser import createParser       # utils video
-from hachoir.metadata import extractMetadata  # utils video
-from PIL import Image as PILImage             # utils image
-from PIL.ExifTags import TAGS                 # utils image
-from multiprocessing import Pool as ProcessPool
-
-##################################################################
-# GENERAL SETTINGS
-##################################################################
-'''
-Defines the verbosity level for the logs.
-DEBUG, INFO, WARNING, ERROR, CRITICAL
-'''
-LOGGER_LEVEL = "WARNING"
-
-logging.basicConfig(level=getattr(logging, LOGGER_LEVEL))
-logger = logging.getLogger(self.__class__.__name__)
-
-'''
-If you're feeling lucky, the script will look for a capture date even if it is not
-on the file's metadata. Note that while this extends the script's capabilities, 
-it is way more error prone. Use at your own risk.
-'''
-IM_FEELING_LUCKY = True
-
-'''
-Organize into folders properties:
-(i) If the number of files belonging to a certain day is > NR_IMAGES_PER_DAY , they'll be
-    placed on a folder for that day
-(ii) Sets the end of a day
-     e.g. photos at 04:00 usually relate to the end of the previous day and not the beggining of the next
-     Note that this does not change the date of the photo itself, it is only used when creating folders
-'''
-NR_IMAGES_PER_DAY = 15
-WEE_SMALL_HOURS_OF_THE_MORNING = "04.00.00"
-
-'''
-Store photos in monthly folders inside of the yearly folder
-i.e. store photos in YYYY/MM if true / YYYY if false
-'''
-MONTHLY_PARTITION = True
-
-'''
-Whether we should also traverse subdirs. It is safer to be turned off
-'''
-TRAVERSE_SUBDIRS = True
-
-##################################################################
-# MACROS
-##################################################################
-EXIF_STANDARD_CREATION_DATE = 1998
-
-DATE_FORMAT = "%Y.%m.%d"
-TIME_FORMAT = "%H.%M.%S"
-OUTPUT_FORMAT = "%Y.%m.%d (%Hh%Mm%Ss)" # This represents how the images will be renamed
-OUTPUT_FORMAT_REGEX = r"(\d{4}\.\d{2}\.\d{2}) \((\d{2}h\d{2}m\d{2}s)\)"
-
-
-
-##################################################################
-# MEDIA VAULT
-##################################################################
-class MediaVault():
-    def __init__(self):
-        self.organizer = Organizer()
-
-    def run(self):
-        logger.info("Media Vault is starting.")
-        for root, dirs, files in os.walk('.'):
-            for filename in sorted(files):
-
-                file = os.path.join(root, filename)
-                self.organizer.ingestFile(file)
-
-            if not TRAVERSE_SUBDIRS:
-                break
-
-        self.organizer.organize()
-
-        logger.info("Success ;)")
-
-
-
-##################################################################
-# VERBOSE LOGGER
-##################################################################
-class VerbositeLogger():
-    class Verbosity(Enum):
-        ERROR = 0
-        WARNING = 1
-        INFO = 2
-        DEBUG = 3
-
-    @staticmethod
-    def log(message, level):
-        if VERBOSITY_LEVEL >= level.value:
-            print(f"[{level.name}] {message}")
-
-
-
-########################################################################
-# ORGANIZER
-#                                                                      #
-# 1st: .ingestFile - Ingest a file and process it, i.e. store the      #
-#                    file path, capture date and capture time on a csv #
-# 2nd: .organize - Rename and organize photos into folders using the   #
-#                  generated csv content                               #
-########################################################################
-class Organizer():
-    def __init__(self):
-        # instantiate necessary classes
-        self.mediaVaultCsv  = MediaVaultCSV()
-
-        # dateCounter --> tracks the number of images per date (to organize into folders)
-        self.dateCounter = {}
-
-        # processedFolder --> the abs path to the folder where processed images should be placed
-        self.processedFolder = os.getcwd() + "/" + "_Media Vault" + "/"
-        if not os.path.exists(self.processedFolder):
-            os.makedirs(self.processedFolder, exist_ok=True)
-
-        # logFile --> each rename/move operation will be logged here
-        logFilePath = self.processedFolder + "_log.md"
-        if not os.path.exists(logFilePath):
-            self.logFile = open(logFilePath, "w", newline='') 
-            self.logFile.write("| Old File Path | New File Path |\n")
-            self.logFile.write("| ------------- | ------------- |\n") 
-        else:
-            self.logFile = open(logFilePath , "a", newline='')
-
-
-    def ingestFile(self, file_path):
-        ''' The entrypoint for individual file processing '''
-        
-        logger.debug(f"Scanning: {file_path}")
-
-        # TODO: add support for non ascii filenames
-        if not file_path.isascii():
-            return
-
-        # Ask MediaProcessorFactory for a processor to process the file
-        try:
-            processor = MediaProcessorFactory().create_processor(file_path)
-            capture_date = processor.process(file_path)
-        except (MediaProcessor.FileTypeNotSupportedException , MediaProcessor.CouldNotExtractCaptureDateException) as e:
-            logger.debug(e)
-            # File could not be processed
-            return
-        date = capture_date[0]
-        time = capture_date[1]
-        file_abs_path = os.path.abspath(file_path)
-
-        # Store file information into csv
-        fileDataToPersistOnCSV = {
-            'OriginalPath': file_abs_path,
-            'CaptureDate': date,
-            'CaptureTime': time,
-            'NewPath' : ''
-        }
-        self.mediaVaultCsv.write(fileDataToPersistOnCSV)
-
-        # Additionally, update the dateCounter
-        dateToCount = self.weeSmallHoursOfTheMorning(date, time)
-        self.dateCounter[dateToCount] = self.dateCounter.get(dateToCount, 0) + 1
-        # TODO BAH - This is horrible, we have a method of one class that writes into other class and then reads back?!  
-
-
-    def organize(self):
-        # Setup the csv reader
-        reader = self.mediaVaultCsv.read()
-        try:
-            # Skip the header row
-            next(reader)
-        except StopIteration:
-            # If there is not a second row, there are no entries
-            print ("No files were processed.")
-            sys.exit(0)
-    	
-        # Traverse csv to rename and organize each file
-        for row in reader:
-            oldFilePath = row[0]
-            date = row[1]
-            time = row[2]
-            
-            # Calculate relative date
-            relativeDate  = self.weeSmallHoursOfTheMorning(date, time)
-            relativeYear  = relativeDate[:4]
-            relativeMonth = relativeDate[5:7]
-
-            # Calculate the new file location and create the necessary folder structure
-            if(MONTHLY_PARTITION):
-                newFileLocation = self.processedFolder + relativeYear + "/" + relativeMonth + "/"  # .../YYYY/MM
-            else:
-                newFileLocation = self.processedFolder + relativeYear + "/"     # .../YYYY
-            if self.dateCounter.get(relativeDate, 0) >= NR_IMAGES_PER_DAY:
-                newFileLocation += relativeDate + "/"                       # .../YYYY/MM/YYYY.MM.DD
-            os.makedirs(newFileLocation, exist_ok=True)
-
-            # Calculate the new file name
-            fileExtension = os.path.splitext(oldFilePath)[1]
-            newFileName = self.renameWithCaptureDate(newFileLocation, fileExtension, date, time)
-
-            # Rename and move the file and log this changes
-            os.rename(oldFilePath, newFileLocation + newFileName)
-            self.logFile.write('|' + oldFilePath + '|' + newFileLocation + newFileName + '|\n')
-        
-        # After traversing, delete mediaVaultCsv
-        self.mediaVaultCsv.delete()
-        
-
-    # Responsible for the logic of WEE_SMALL_HOURS_OF_THE_MORNING
-    # Returns a date
-    def weeSmallHoursOfTheMorning(self, date, time):
-        # if time is not available, don't perform any computation, just return the date
-        if not time:
-            return date
-
-        timeFormatted         = datetime.strptime(time, TIME_FORMAT)
-        timeEndOfDayFormatted = datetime.strptime(WEE_SMALL_HOURS_OF_THE_MORNING , TIME_FORMAT)
-        time_difference = abs( int( (timeFormatted - timeEndOfDayFormatted).days ) )
-        date = str( (datetime.strptime(date, DATE_FORMAT) - timedelta(days=time_difference)) ).replace("-",".")[:10]
-        return date
-
-
-    # Responsible for returning the new file name
-    def renameWithCaptureDate(self, newFileLocation, fileExtension, date, time):
-        # Calculate newFilename
-        if time:
-            newFilename = str(datetime.strptime(date + ' ' + time, DATE_FORMAT + ' ' + TIME_FORMAT).strftime(OUTPUT_FORMAT))
-        else:
-            newFilename = date
-
-        # Find a unique filename (to ensure we avoid overriding on the newFileLocation)
-        counter = 1
-        newUniqueFilename = f"{newFilename}{fileExtension}"
-        while (os.path.exists(newFileLocation + newUniqueFilename)):
-            newUniqueFilename = f"{newFilename} ({counter}){fileExtension}"
-            counter += 1
-
-        return newUniqueFilename
-
-
-
-##################################################################
-# MEDIA VAULT CSV
-##################################################################
-class MediaVaultCSV():
-    def __init__(self):
-        # csvFile --> a csv where ingest() will write and from which organize() will read afterwards
-        self.csvFile = os.getcwd() + "/" + "mediaVaultData.csv"
-        self.setup()
-
-
-    # Sets up the mediaVaultCsv on instantiation
-    def setup(self):
-        if os.path.exists(self.csvFile):
-            logger.error("A mediaVaultData.csv already exists in the working directory. Will not override it.")
-            sys.exit(1)  # Halt the program as it should not run with logging its changes
-
-        # TODO BAH - do we really need headers here to then skip the first row on organizer.organize()? rethink this, looks awful
-        try:
-            headerCSV = {
-                'OriginalPath': 'OriginalPath',
-                'CaptureDate': 'CaptureDate',
-                'CaptureTime': 'CaptureTime',
-                'NewPath' : 'NewPath'
-            }
-            self.write(headerCSV)
-        except Exception as e:
-            logger.error(f"Halting. Unable to create/write to MediaVaultData.csv due to: {str(e)}.")
-            sys.exit(1) # Halt
-
-
-    # Writes a row to the mediaVaultData.csv provided a dictionary with the following fields:
-    # 'OriginalPath' , 'CaptureDate' , 'CaptureTime' , 'NewPath' (the order needs to be followed!)
-    def write(self, row):
-        with open(self.csvFile, "a", newline='') as file:
-            # Write the header to the CSV file
-            csv.writer(file).writerow(row.values())
-        file.close()
-
-
-    # Returns a csv.reader
-    def read(self):
-        # Setup the csv reader
-        try:
-            file = open(self.csvFile, 'r')
-            reader = csv.reader(file)
-            if reader:
-                return reader
-            else:
-                # If the CSV is empty, halt the program
-                logger.error("MediaVaultCsv file is empty. Halting.")
-                sys.exit(1)
-        except Exception as e:
-            logger.error(f"{str(e)}")
-            sys.exit(1)
-
-
-    def delete(self):
-        if os.path.exists(self.csvFile):
-            os.remove(self.csvFile)
-
-
-
-##################################################################
-# MEDIA PROCESSOR
-##################################################################
-class MediaProcessor(ABC):
-    class FileTypeNotSupportedException(Exception):
-        ''' This exception will be raised if the file extension is not supported '''
-        pass
-
-    class CouldNotExtractCaptureDateException(Exception):
-        ''' This exception will be raised if the capture date could not be extracted '''
-        pass
-
-    @abstractmethod
-    def process(self, file_path):
-        """
-        Process a given file.
-        """
-        pass
-
-    @abstractmethod
-    def is_supported(self, file_path):
-        """
-        Check if the file is of supported media type.
-        """
-        pass
-
-    @abstractmethod
-    def get_capture_date(self, file_path):
-        """
-        Extract capture date from the media file.
-        """
-        pass
-        
-    def is_valid_datetime(self, date, time=None):
-        if date is None:
-            return False
-        try:
-            # Parse date and time
-            datetime_str    = f"{date} {time}" if time else date
-            datetime_format = f"{DATE_FORMAT} {TIME_FORMAT}" if time else DATE_FORMAT
-            datetime_obj    = datetime.strptime(datetime_str, datetime_format)
-            # Ensure the date is within a reasonable range
-            if datetime_obj.year < 1990 or datetime_obj > datetime.now():
-                return False
-            return True
-        except ValueError:
-            return False
-
-    def im_feeling_lucky(self, file_path):
-        ''' if the capture date fails to be retrieved from the file's metadata,
-            this method will try to retrieve it from the filename '''
-        filename = os.path.basename(file_path)
-        SEARCH_PATTERNS_LIST = [
-            # Whatsapp
-            r'IMG_(\d{4})(\d{2})(\d{2})',
-            r'WhatsApp Image (\d{4})-(\d{2})-(\d{2}) at (\d{2})\.(\d{2})\.(\d{2})',
-            r'WhatsApp Video (\d{4})-(\d{2})-(\d{2}) at (\d{2})\.(\d{2})\.(\d{2})',
-            r'IMG_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})', 
-            r'IMG-(\d{4})(\d{2})(\d{2})',
-            r'VID-(\d{4})(\d{2})(\d{2})',
-            # Samsung phone 2022
-            r'Screenshot_(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})',
-            r'(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})',
-            # This script (and older versions) so it is idempotent
-            r'(\d{4})\.(\d{2})\.(\d{2}) \((\d{2})h(\d{2})m(\d{2})s\)',
-            r'(\d{4})\.(\d{2})\.(\d{2}) (?: \(\d+\))?',
-            # Other
-            r'WIN-(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})',
-            r'WIN-(\d{4})(\d{2})(\d{2})_(\d{2})_(\d{2})_(\d{2})_Pro'
-        ]
-        for pattern in SEARCH_PATTERNS_LIST:
-            match = re.search(pattern, filename)
-            if match:
-                groups = match.groups()
-                if len(groups) == 3:  # if it matched a date
-                    year, month, day = groups
-                    date = f"{year}.{month}.{day}"
-                    time = None
-                elif len(groups) == 6:  # if it matched a date and a time
-                    year, month, day, hour, minute, second = groups
-                    date = f"{year}.{month}.{day}"
-                    time = f"{hour}.{minute}.{second}"
-                if self.is_valid_datetime(date, time):
-                    return (date, time)
-        # Exit gracefully
-        raise MediaProcessor.CouldNotExtractCaptureDateException("Could not extract a capture date")
-
-
-
-##################################################################
-# MEDIA PROCESSOR FACTORY
-##################################################################
-class MediaProcessorFactory:
-    @staticmethod
-    def create_processor(file_path):
-        if ImageProcessor().is_supported(file_path):
-            return ImageProcessor()
-        elif VideoProcessor().is_supported(file_path):
-            return VideoProcessor()
-        else:
-            raise MediaProcessor.FileTypeNotSupportedException("File type is not supported")
-
-
-
-##################################################################
-# MEDIA PROCESSOR >> IMAGE PROCESSOR
-##################################################################
-class ImageProcessor(MediaProcessor):
-    def process(self, file_path):
-        if not self.is_supported(file_path):
-            raise MediaProcessor.FileTypeNotSupportedException("File type is not supported")
-        return self.get_capture_date(file_path)
-
-    def is_supported(self, file_path):
-        '''
-        Check if file is supported (i.e. an image)
-        '''
-        try:
-            PILImage.open(file_path)
-            return True
-        except (IOError, SyntaxError):
-            return False
-
-    def get_capture_date(self, file_path):
-        try:
-            image = PILImage.open(file_path)
-            for tag_id, value in image._getexif().items():
-                if TAGS.get(tag_id, tag_id) == "DateTimeOriginal":
-                    capture_date = str(value)
-                    if capture_date:
-                        capture_date = datetime.strptime(capture_date, "%Y:%m:%d %H:%M:%S")
-                        date = capture_date.strftime(DATE_FORMAT)
-                        time = capture_date.strftime(TIME_FORMAT)
-                        if self.is_valid_datetime(date, time):
-                            return (date, time)
-        except Exception as e:
-            # Handle all exceptions gracefully
-            pass
-
-        # Delegate to im_feeling_lucky or just assume a capture date was not found
-        if (IM_FEELING_LUCKY):
-            return self.im_feeling_lucky(file_path)
-        else:
-            raise MediaProcessor.CouldNotExtractCaptureDateException("Could not extract a capture date")
-
-
-
-##################################################################
-# MEDIA PROCESSOR >> VIDEO PROCESSOR
-##################################################################
-class VideoProcessor(MediaProcessor):
-    def process(self, file_path):
-        if not self.is_supported(file_path):
-            raise MediaProcessor.FileTypeNotSupportedException("File type is not supported")
-        return self.get_capture_date(file_path)
-        if self.is_supported(file_path):
-            return self
-        else:
-            return None
-
-    def is_supported(self, file_path):
-        '''
-        Check if file is supported (i.e. a video)
-        Current support only includes video formats that typically store capture dates in the format "%Y-%m-%d %H:%M:%S"
-        '''
-        SUPPORTED_VIDEO_EXTENSIONS = ['.mp4', '.mov', '.mkv', '.avi', '.flv', '.webm', '.m4v']
-        file_extension = os.path.splitext(file_path)[1].lower()
-        return file_extension in SUPPORTED_VIDEO_EXTENSIONS
-
-    def get_capture_date(self, file_path):
-        try:
-            capture_date = str(extractMetadata(createParser(file_path)).get('creation_date'))
-            if capture_date:
-                capture_date = datetime.strptime(capture_date, "%Y-%m-%d %H:%M:%S")
-                date = capture_date.strftime(DATE_FORMAT)
-                time = capture_date.strftime(TIME_FORMAT)
-                if self.is_valid_datetime(date, time):
-                    return (date, time)
-        except Exception as e:
-            # Handle all exceptions gracefully
-            pass
-
-        # Delegate to im_feeling_lucky or just assume a capture date was not found
-        if (IM_FEELING_LUCKY):
-            return self.im_feeling_lucky(file_path)
-        else:
-            raise MediaProcessor.CouldNotExtractCaptureDateException("Could not extract a capture date")
-
-
-
-##################################################################
-# REVERT
-##################################################################
-class Revert():
-    def run(self):
-        '''
-        This mode reverts the operations of MediaVault.py, restoring all new file paths to their previous state. 
-        If you only want to revert some of the changes, move all the files you 
-        don't want to revert to a separate folder before running.
-        '''
-        logger.info("Starting revert operation.")
-        with open("./_Media Vault/_log.md", 'r') as file:
-            content = file.readlines()
-            for line in content:
-                # Split the line by the pipe character '|'
-                parts = [part.strip() for part in line.split("|") if part.strip()]
-                # Extract the values
-                old_path = parts[0]
-                new_path = parts[1]
-                # Try to revert (new_path --> old_path)
-                try:
-                    if os.path.exists(new_path):
-                        os.rename(new_path, old_path)
-                        logger.debug(f"Renamed {new_path} to {old_path}")
-                    else:
-                        # File does not exist
-                        pass
-                except Exception as e:
-                    logger.error(f"An error occurred while processing {new_path}: {e}")
-        logger.info("Success ;)")
-
-
-##################################################################
-# EXECUTION
-##################################################################
-def main():
-    parser = argparse.ArgumentParser(description="Media Vault Script")
-    parser.add_argument("--revert", "-r", action="store_true", help="revert the operation")
-    args = parser.parse_args()
-
-    if args.revert:
-        revert = Revert()
-        revert.run()
-    else:
-        mediaVault = MediaVault()
-        mediaVault.run()
-
-
-
-if __name__ == "__main__":
-    main()
+import argparse
+import csv
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import hashlib
+import heapq
+import importlib
+import io
+import json
+import logging
+import os
+import queue
+import re
+import select
+import signal
+import stat
+import sys
+import shutil
+import sqlite3
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta      # utils date
+from enum import Enum
+from itertools import islice
+from time import perf_counter, sleep
+
+##################################################################
+# LAZY IMPORTS
+##################################################################
+class LazyImport():
+    '''
+    Stands in for a module (or for one of its attributes) that is only imported when it is first used, so that
+    runs which never parse a file (e.g. --revert) do not pay for loading PIL, hachoir or multiprocessing
+    '''
+    def __init__(self, module, attribute=None):
+        self.module = module
+        self.attribute = attribute
+        self.target = None
+
+    def load(self):
+        if self.target is None:
+            try:
+                target = importlib.import_module(self.module)
+            except ImportError as e:
+                logger.error(f"Unable to import {self.module}: {str(e)}.")
+                sys.exit(1)
+            self.target = getattr(target, self.attribute) if self.attribute else target
+        return self.target
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+createParser = LazyImport("hachoir.parser", "createParser")          # utils video
+extractMetadata = LazyImport("hachoir.metadata", "extractMetadata")  # utils video
+PILImage = LazyImport("PIL.Image")                                   # utils image
+ProcessPool = LazyImport("multiprocessing", "Pool")
+
+##################################################################
+# GENERAL SETTINGS
+##################################################################
+'''
+Defines the verbosity level for the logs.
+DEBUG, INFO, WARNING, ERROR, CRITICAL
+'''
+LOGGER_LEVEL = "WARNING"
+
+logging.basicConfig(level=getattr(logging, LOGGER_LEVEL))
+logger = logging.getLogger("MediaVault")
+
+'''
+If you're feeling lucky, the script will look for a capture date even if it is not
+on the file's metadata. Note that while this extends the script's capabilities, 
+it is way more error prone. Use at your own risk.
+'''
+IM_FEELING_LUCKY = True
+
+r'''
+Extra filename patterns used when you're feeling lucky (tried after the built-in ones).
+Each pattern must capture (year, month, day) or (year, month, day, hour, minute, second)
+Flags must be scoped to a group, e.g. r'(?i:pxl)_(\d{4})(\d{2})(\d{2})' rather than r'(?i)pxl_...'
+e.g. r'PXL_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})'
+'''
+LUCKY_EXTRA_PATTERNS = []
+
+'''
+Organize into folders properties:
+(i) If the number of files belonging to a certain day is > NR_IMAGES_PER_DAY , they'll be
+    placed on a folder for that day
+(ii) Sets the end of a day
+     e.g. photos at 04:00 usually relate to the end of the previous day and not the beggining of the next
+     Note that this does not change the date of the photo itself, it is only used when creating folders
+'''
+NR_IMAGES_PER_DAY = 15
+WEE_SMALL_HOURS_OF_THE_MORNING = "04.00.00"
+
+'''
+Store photos in monthly folders inside of the yearly folder
+i.e. store photos in YYYY/MM if true / YYYY if false
+'''
+MONTHLY_PARTITION = True
+
+'''
+Whether we should also traverse subdirs. It is safer to be turned off
+'''
+TRAVERSE_SUBDIRS = True
+
+'''
+Files and folders left out of the scan (folders are not even listed), matched against their name
+and against their path relative to the folder where the script runs
+e.g. ["*.tmp", "@eaDir", "Backups/*"]
+'''
+IGNORE_GLOBS = []
+
+'''
+Number of threads listing folders (and stat'ing their files) in parallel, which pays off on network mounts (SMB/NFS)
+'''
+NR_WALK_THREADS = 16
+
+'''
+Number of worker processes used to ingest files (i.e. to extract their capture dates).
+1 keeps everything on a single core, 0 uses every core available
+'''
+NR_WORKERS = 1
+
+'''
+Keep a cache of the capture dates extracted on previous runs (stored in the _Media Vault folder),
+so that only new or changed files are parsed. It holds at most METADATA_CACHE_SIZE files, 0 disables it
+'''
+METADATA_CACHE_SIZE = 1000000
+
+'''
+Where ingested files are recorded until they are organized: "sqlite" or "csv"
+'''
+MANIFEST_BACKEND = "sqlite"
+
+'''
+Number of threads renaming/moving files into the _Media Vault folder
+'''
+NR_MOVE_THREADS = 8
+
+'''
+Files living on a different file system than the _Media Vault folder (e.g. an SD card) are copied and then deleted:
+(i) At most NR_CONCURRENT_COPIES files are copied at the same time
+(ii) If VERIFY_TRANSFERS, the copy is hashed and compared with the original before the original is deleted
+'''
+NR_CONCURRENT_COPIES = 2
+VERIFY_TRANSFERS = True
+
+'''
+What to do with files whose content already lives in the _Media Vault folder:
+None --> store them anyway (they get a counter on their name, e.g. "2023.01.05 (1).jpg")
+"skip" --> leave them where they are
+"hardlink" --> replace them by a hard link to the copy in the _Media Vault folder (falls back to "skip" across file systems)
+'''
+DEDUPLICATE = None
+
+'''
+Run as a streaming pipeline: files are moved while the folder is still being scanned and parsed
+(instead of only after every file was ingested). At most PIPELINE_QUEUE_SIZE files wait between stages
+'''
+STREAMING_PIPELINE = False
+PIPELINE_QUEUE_SIZE = 1000
+
+'''
+Low memory mode (also enabled with --low-memory), for libraries of millions of files on small machines (e.g. a NAS with 1 GB of RAM):
+what would grow with the number of files is kept on disk (the csv manifest is sorted in runs spilled to temporary files,
+the paths of a resumed run live on temporary sqlite databases) and the sort runs are sized after MEMORY_LIMIT (in MB),
+shrinking while the memory usage is over it. MEMORY_LIMIT is a target rather than a hard cap: the peak memory usage is
+logged at the end of every run, with a warning if a low memory run still went over MEMORY_LIMIT
+'''
+LOW_MEMORY = False
+MEMORY_LIMIT = 512
+
+'''
+Import time budgets (in milliseconds) checked by --startup-profile, per top level module
+(e.g. "PIL", "hachoir", "MediaVault" itself) and for all the imports together ("total").
+The profile exits with an error if the profiled command goes over any of them
+'''
+STARTUP_PROFILE_THRESHOLDS = {"MediaVault": 25, "total": 150}
+
+'''
+Every PROGRESS_INTERVAL seconds a progress line (files/sec and, once the total is known, ETA) is printed. 0 disables it
+'''
+PROGRESS_INTERVAL = 10
+
+'''
+At the end of a run, the metrics (counters and latency histograms of each stage) are saved as JSON on this file,
+inside the _Media Vault folder. None disables it
+'''
+METRICS_REPORT_FILE = "_metrics.json"
+
+'''
+Functions called with ("progress" or "end", metrics report) to export the metrics to your own collector
+e.g. METRICS_HOOKS = [lambda event, report: print(event, report["counters"])]
+'''
+METRICS_HOOKS = []
+
+'''
+Watch mode (--watch): a file is only organized once its size and modification time have not changed for
+WATCH_SETTLE_TIME seconds (so files still being written are left alone). Where inotify is not available
+(i.e. not on Linux) the folder is polled every WATCH_POLL_INTERVAL seconds
+'''
+WATCH_SETTLE_TIME = 0.5
+WATCH_POLL_INTERVAL = 2
+
+##################################################################
+# MACROS
+##################################################################
+EXIF_STANDARD_CREATION_DATE = 1998
+
+DATE_FORMAT = "%Y.%m.%d"
+TIME_FORMAT = "%H.%M.%S"
+OUTPUT_FORMAT = "%Y.%m.%d (%Hh%Mm%Ss)" # This represents how the images will be renamed
+OUTPUT_FORMAT_REGEX = r"(\d{4}\.\d{2}\.\d{2}) \((\d{2}h\d{2}m\d{2}s)\)"
+
+INGEST_CHUNKSIZE = 64 # Number of files handed to an ingest worker at a time
+METADATA_CACHE_COMMIT_INTERVAL = 1000 # Number of cache updates per transaction
+MANIFEST_BATCH_SIZE = 1000 # Number of manifest rows written per transaction
+MOVES_IN_FLIGHT_PER_THREAD = 4 # Number of moves queued on each move thread
+TRANSFER_BUFFER_SIZE = 1024 * 1024 # Bytes per read/write when files are copied or hashed
+DEDUP_SAMPLE_SIZE = 64 * 1024 # Bytes hashed at the beginning and at the end of a file to prefilter duplicates
+JOURNAL_GROUP_SIZE = 256 # Number of moves whose intents are fsync'ed together (before any of them starts)
+INGEST_WINDOW = 10000 # Number of files looked up on the metadata cache before their misses are handed to the workers
+WALK_LOOKAHEAD = 4 # Number of folders listed ahead of the walk, per walk thread
+
+
+
+##################################################################
+# MEDIA VAULT
+##################################################################
+class MediaVault():
+    # shard --> (index, count) of the shard to ingest, merge --> number of shards whose files are organized (see Shard)
+    def __init__(self, workers=NR_WORKERS, streaming=STREAMING_PIPELINE, resume=False, shard=None, merge=None):
+        self.workers = workers
+        self.streaming = streaming
+        self.shard = Shard(*shard) if shard else None
+        self.shards = Shard.all(merge) if merge else None
+        # A shard can only be run by one process at a time, and the merge holds every shard while it runs
+        # locks --> the lock files taken (only these are released, as the others belong to another run)
+        self.locks = []
+        try:
+            for lockFile in [self.shard.lockFile] if self.shard else [shard.lockFile for shard in self.shards or []]:
+                Shard.lock(lockFile, takeOver=resume)
+                self.locks.append(lockFile)
+            if self.shards:
+                Shard.checkIngested(self.shards)
+            self.organizer = Organizer(resume, self.shard, self.shards)
+        except BaseException:
+            self.unlock()
+            raise
+
+    def run(self):
+        logger.info("Media Vault is starting.")
+        try:
+            if self.streaming:
+                # Files are moved while scanning, so the scan must not walk into the _Media Vault folder
+                StreamingPipeline(self.organizer, self.workers).run(self.scan())
+            else:
+                if not self.organizer.journal.ingested:
+                    # The files of a merge were ingested by the shards
+                    if not self.shards:
+                        # When resuming, the files already on the manifest are not parsed again
+                        ingested = self.organizer.manifest.paths()
+                        owned = (file_path for file_path in self.scan() if not self.shard or self.shard.owns(file_path))
+                        self.organizer.ingestFiles((file_path for file_path in owned if os.path.abspath(file_path) not in ingested), self.workers)
+                    # The manifest must be on disk before the ingest is journaled as done
+                    self.organizer.manifest.flush()
+                    self.organizer.journal.markIngested()
+                # A shard only ingests: its manifest is organized by the merge
+                if not self.shard:
+                    self.organizer.organize()
+            self.organizer.journal.end()
+            self.organizer.close()
+        finally:
+            self.unlock()
+
+        logger.info("Success ;)")
+
+    def unlock(self):
+        for lockFile in self.locks:
+            Shard.unlock(lockFile)
+
+
+    # Watch mode: organizes the files as they land on the folder, until interrupted
+    def watch(self):
+        logger.info("Media Vault is watching for new files.")
+        organizer = self.organizer
+        dayCounter = DayCounter(organizer.processedFolder + "_days.sqlite", organizer)
+        watcher = Watcher.create(os.getcwd(), organizer.processedFolder.rstrip("/"), {organizer.manifest.manifestFile})
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for batch in watcher.batches():
+                for file_path in batch:
+                    try:
+                        organizer.ingestFile(file_path)
+                    except OSError as e:
+                        logger.warning(f"Unable to ingest {file_path} due to: {str(e)}.")
+                organizer.metadataCache.commit()
+                organizer.organizeBatch(dayCounter)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            dayCounter.close()
+            organizer.manifest.delete()
+            organizer.journal.end()
+            organizer.close()
+        logger.info("Media Vault stopped watching.")
+
+
+    # Yields the DirEntry of every file to be ingested (in a deterministic order)
+    def scan(self):
+        return Walker(".", {self.organizer.processedFolder.rstrip("/")}).walk()
+
+
+
+##################################################################
+# WALKER
+##################################################################
+class Walker():
+    '''
+    Lists folders on a thread pool (a listing submits the listings of its subfolders straight away, so many folders
+    are read at once) while the files are yielded in the order of a sequential depth first walk: the files of a folder
+    sorted by name, then each of its subfolders sorted by name. Files are yielded as DirEntry objects whose stat
+    result was already fetched on the pool, so they are not stat'ed again.
+    At most NR_WALK_THREADS * WALK_LOOKAHEAD folders (a single one per thread in low memory mode) are listed ahead
+    of the walk (the others wait as paths), so the listings held in memory do not grow with the library.
+    Pruned folders (i.e. _Media Vault) and IGNORE_GLOBS are left out before being listed
+    '''
+    ignoredPattern = None
+
+    def __init__(self, root, prunedFolders=(), threads=NR_WALK_THREADS):
+        self.root = root
+        self.prunedFolders = prunedFolders
+        self.threads = threads
+        self.lookahead = threads * (1 if memoryBudget.enabled else WALK_LOOKAHEAD)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = 0 # listings submitted and not walked yet
+
+    # Whether a name or a path relative to the root matches IGNORE_GLOBS
+    @classmethod
+    def ignored(cls, name, relativePath):
+        if not IGNORE_GLOBS:
+            return False
+        if cls.ignoredPattern is None:
+            cls.ignoredPattern = re.compile("|".join(fnmatch.translate(glob) for glob in IGNORE_GLOBS))
+        return bool(cls.ignoredPattern.match(name) or cls.ignoredPattern.match(relativePath))
+
+    # Sort key of a path (under the folder where the script runs) that follows the order of the walk
+    @staticmethod
+    def walkKey(path):
+        parts = os.path.relpath(path).split(os.sep)
+        return [(1, folder) for folder in parts[:-1]] + [(0, parts[-1])]
+
+    def walk(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="walk")
+        try:
+            # Folders to walk, the next one last: listings (futures) or paths of the folders not listed yet
+            folders = [self.submit(self.root)]
+            while folders:
+                folder = folders.pop()
+                if isinstance(folder, str):
+                    folder = self.submit(folder, force=True)
+                files, subfolders = folder.result()
+                with self.lock:
+                    self.pending -= 1
+                yield from files
+                folders.extend(reversed(subfolders))
+                self.prefetch(folders)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Lists a folder on the pool, unless too many listings are pending (its path is returned instead)
+    def submit(self, folder, force=False):
+        with self.lock:
+            if not force and self.pending >= self.lookahead:
+                return folder
+            self.pending += 1
+        return self.executor.submit(self.list, folder)
+
+    # Submits the listings of the next folders to walk that are still paths, as long as there is room for them
+    def prefetch(self, folders):
+        for index in range(len(folders) - 1, max(len(folders) - self.lookahead, 0) - 1, -1):
+            if isinstance(folders[index], str):
+                folders[index] = self.submit(folders[index])
+                if isinstance(folders[index], str):
+                    return
+
+    # Runs on the pool: returns (the files of a folder, the listings or paths of its subfolders), both sorted by name
+    def list(self, folder):
+        started = perf_counter()
+        try:
+            with os.scandir(folder) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning(f"Unable to list {folder} due to: {str(e)}.")
+            return [], []
+        files = []
+        subfolders = []
+        for entry in entries:
+            if Walker.ignored(entry.name, entry.path[len(self.root) + 1:]):
+                continue
+            if entry.is_dir():
+                if TRAVERSE_SUBDIRS and not entry.is_symlink() and os.path.abspath(entry.path) not in self.prunedFolders:
+                    try:
+                        subfolders.append(self.submit(entry.path))
+                    except RuntimeError:
+                        # The walk was abandoned
+                        return [], []
+            else:
+                try:
+                    entry.stat() # cached on the entry
+                except OSError:
+                    pass
+                files.append(entry)
+        metrics.observe("walk.scandir", perf_counter() - started)
+        return files, subfolders
+
+
+
+##################################################################
+# STREAMING PIPELINE
+#
+# scan (producer thread) --> parse (worker processes) --> move (thread pool)
+##################################################################
+class StreamingPipeline():
+    '''
+    Overlaps the scan, the parsing and the moves, with bounded queues in between so memory stays flat.
+    A relative date only gets its own folder once it holds NR_IMAGES_PER_DAY files, so files are staged per relative
+    date until that happens (their folder can no longer change from then on) or until the scan ends. Staged files are
+    kept on a private temporary sqlite database (deleted once closed), as a library of sparse days stages most of them.
+    Names are planned in scan order within each relative date, hence the outcome matches a regular run
+    '''
+    END_OF_SCAN = None
+
+    def __init__(self, organizer, workers):
+        self.organizer = organizer
+        self.workers = workers
+        # dateCounter --> number of files per relative date seen so far
+        # staged --> files waiting for the folder of their relative date to be settled, in scan order (seq)
+        self.dateCounter = {}
+        self.staged = sqlite3.connect("")
+        self.staged.execute("CREATE TABLE staged (seq INTEGER PRIMARY KEY, relative_date TEXT, path TEXT, date TEXT, time TEXT)")
+        self.staged.execute("CREATE INDEX staged_relative_date ON staged (relative_date, seq)")
+        self.scanError = None
+
+    def run(self, file_paths):
+        self.organizer.runMoves(lambda: self.ingest(self.produce(file_paths)))
+        self.staged.close()
+        self.organizer.metadataCache.commit()
+        self.organizer.reportFormats()
+        self.organizer.manifest.delete()
+
+    # Scans on a separate thread, yielding the files found as they come
+    def produce(self, file_paths):
+        scanQueue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        def scan():
+            try:
+                for file_path in file_paths:
+                    scanQueue.put(file_path)
+            except Exception as e:
+                self.scanError = e
+            finally:
+                scanQueue.put(StreamingPipeline.END_OF_SCAN)
+        threading.Thread(target=scan, name="scan", daemon=True).start()
+
+        for file_path in iter(scanQueue.get, StreamingPipeline.END_OF_SCAN):
+            yield file_path
+        if self.scanError:
+            raise self.scanError
+
+    # Parses the files (cache misses on the worker processes) and stages their results in scan order
+    def ingest(self, file_paths):
+        cache = self.organizer.metadataCache
+        window = deque() # (fileKey, IngestResult or AsyncResult of a worker)
+        metrics.start("ingest")
+        pool = ProcessPool(processes=self.workers or None, initializer=Metrics.initWorker) if self.workers != 1 else None
+        try:
+            for file_path in file_paths:
+                fileKey = MetadataCache.file_key(file_path)
+                result = cache.get(fileKey)
+                if result is None:
+                    if pool:
+                        result = pool.apply_async(Organizer.extractInWorker, (os.fspath(file_path),))
+                    else:
+                        result = Organizer.extractCaptureDate(file_path)
+                        cache.put(fileKey, result)
+                window.append((fileKey, result))
+                while window and (len(window) >= PIPELINE_QUEUE_SIZE or self.isReady(window[0][1])):
+                    self.stage(*window.popleft())
+            while window:
+                self.stage(*window.popleft())
+        finally:
+            if pool:
+                pool.terminate()
+
+        # The scan is over: every date left on stage stays on the monthly/yearly folder
+        for relativeDate, path, date, time in self.staged.execute(
+                "SELECT relative_date, path, date, time FROM staged ORDER BY relative_date, seq"):
+            newFileLocation = self.organizer.targetDirectory(relativeDate, self.dateCounter[relativeDate])
+            self.organizer.scheduleMove(path, self.organizer.datePlanner.filename(date, time), newFileLocation)
+
+    @staticmethod
+    def isReady(result):
+        return isinstance(result, IngestResult) or result.ready()
+
+    def stage(self, fileKey, result):
+        if not isinstance(result, IngestResult):
+            result, workerMetrics = result.get()
+            metrics.merge(workerMetrics)
+            self.organizer.metadataCache.put(fileKey, result)
+        self.organizer.countFormat(result)
+        if result.date is None:
+            return
+
+        relativeDate = self.organizer.datePlanner.relativeDate(result.date, result.time)
+        dateCount = self.dateCounter[relativeDate] = self.dateCounter.get(relativeDate, 0) + 1
+        if dateCount < NR_IMAGES_PER_DAY:
+            self.staged.execute("INSERT INTO staged (relative_date, path, date, time) VALUES (?, ?, ?, ?)",
+                                (relativeDate, os.fspath(result.path), result.date, result.time))
+            return
+
+        # The date has its own folder for good: release the files staged so far (the date is not staged again)
+        newFileLocation = self.organizer.targetDirectory(relativeDate, dateCount)
+        if dateCount == NR_IMAGES_PER_DAY:
+            for path, date, time in self.staged.execute(
+                    "SELECT path, date, time FROM staged WHERE relative_date = ? ORDER BY seq", (relativeDate,)).fetchall():
+                self.organizer.scheduleMove(path, self.organizer.datePlanner.filename(date, time), newFileLocation)
+            self.staged.execute("DELETE FROM staged WHERE relative_date = ?", (relativeDate,))
+        self.organizer.scheduleMove(result.path, self.organizer.datePlanner.filename(result.date, result.time), newFileLocation)
+
+
+
+##################################################################
+# VERBOSE LOGGER
+##################################################################
+class VerbositeLogger():
+    class Verbosity(Enum):
+        ERROR = 0
+        WARNING = 1
+        INFO = 2
+        DEBUG = 3
+
+    @staticmethod
+    def log(message, level):
+        if VERBOSITY_LEVEL >= level.value:
+            print(f"[{level.name}] {message}")
+
+
+
+# The outcome of ingesting a file: date and time are None if a capture date could not be extracted,
+# processor is None if the file type is not supported and file_format is the type reported by FileTriage
+IngestResult = namedtuple('IngestResult', ['path', 'date', 'time', 'processor', 'file_format'])
+
+
+########################################################################
+# ORGANIZER
+#                                                                      #
+# 1st: .ingestFile - Ingest a file and process it, i.e. store the      #
+#                    file path, capture date and capture time on the   #
+#                    manifest                                          #
+# 2nd: .organize - Rename and organize photos into folders using the   #
+#                  manifest content                                    #
+########################################################################
+class Organizer():
+    # shard --> the Shard ingested by this run, shards --> the shards merged by this run (see Shard)
+    def __init__(self, resume=False, shard=None, shards=None):
+        # instantiate necessary classes
+        # processedFolder --> the abs path to the folder where processed images should be placed
+        self.processedFolder = os.getcwd() + "/" + "_Media Vault" + "/"
+        if not os.path.exists(self.processedFolder):
+            os.makedirs(self.processedFolder, exist_ok=True)
+
+        # manifest --> ingested files and the number of files per date (to organize into folders)
+        # A shard writes a manifest of its own, a merge reads the manifests of every shard
+        if shard:
+            self.manifest = ShardManifest(shard.manifestFile, resume)
+        elif shards:
+            self.manifest = MergedManifest([ShardManifest(shard.manifestFile, resume=True) for shard in shards])
+        else:
+            self.manifest = Manifest.create(resume)
+
+        # journal --> each rename/move operation will be journaled here (and can be resumed or reverted from it)
+        self.journal = Journal(shard.journalFile if shard else self.processedFolder + "_journal.jsonl")
+        self.journal.start(resume)
+        if resume:
+            self.recover()
+
+        # metadataCache --> capture dates extracted on previous runs
+        self.metadataCache = MetadataCache(shard.cacheFile if shard else self.processedFolder + "_cache.sqlite", METADATA_CACHE_SIZE)
+        self.metricsFile = None
+        if METRICS_REPORT_FILE:
+            self.metricsFile = shard.metricsFile if shard else self.processedFolder + METRICS_REPORT_FILE
+
+        # formatCounter --> tracks the number of ingested files per type
+        self.formatCounter = {}
+
+        # transferEngine --> renames files or copies them across file systems
+        self.transferEngine = TransferEngine(NR_CONCURRENT_COPIES)
+
+        # dedupIndex --> the content of the files in the processedFolder (to skip duplicates)
+        self.dedupIndex = DedupIndex(self.processedFolder + "_dedup.sqlite", self.processedFolder) if DEDUPLICATE and not shard else None
+        self.duplicateCounter = 0
+
+        # directoryIndex --> the (lowercase) names taken on each target folder, listed once and then kept up to date
+        # nameCounters --> the next collision counter to try for each target file name
+        self.directoryIndex = {}
+        self.nameCounters = {}
+        self.datePlanner = DatePlanner()
+
+
+    def ingestFile(self, file_path):
+        ''' The entrypoint for individual file processing '''
+        fileKey = MetadataCache.file_key(file_path)
+        result = self.metadataCache.get(fileKey)
+        if result is None:
+            result = Organizer.extractCaptureDate(file_path)
+            self.metadataCache.put(fileKey, result)
+        self.storeCaptureDate(result)
+
+
+    def ingestFiles(self, file_paths, workers=NR_WORKERS):
+        ''' Ingests several files, spreading the capture date extraction across worker processes.
+            Results are consumed in the same order as file_paths, so the outcome matches a serial run '''
+        metrics.start("ingest")
+        if workers == 1:
+            for file_path in file_paths:
+                self.ingestFile(file_path)
+            self.metadataCache.commit()
+            self.reportFormats()
+            return
+
+        # Only the files missing from the cache are handed to the workers, INGEST_WINDOW files at a time
+        file_paths = iter(file_paths)
+        with ProcessPool(processes=workers or None, initializer=Metrics.initWorker) as pool:
+            while True:
+                lookups = []
+                for file_path in islice(file_paths, INGEST_WINDOW):
+                    fileKey = MetadataCache.file_key(file_path)
+                    lookups.append((file_path, fileKey, self.metadataCache.get(fileKey)))
+                if not lookups:
+                    break
+                misses = (os.fspath(file_path) for file_path, fileKey, result in lookups if result is None)
+                extracted = pool.imap(Organizer.extractInWorker, misses, chunksize=INGEST_CHUNKSIZE)
+                for file_path, fileKey, result in lookups:
+                    if result is None:
+                        result, workerMetrics = next(extracted)
+                        metrics.merge(workerMetrics)
+                        self.metadataCache.put(fileKey, result)
+                    self.storeCaptureDate(result)
+        self.metadataCache.commit()
+        self.reportFormats()
+
+
+    # Runs on the ingest workers, hence it must not touch any state owned by the Organizer
+    # Returns an IngestResult
+    @staticmethod
+    def extractCaptureDate(file_path):
+        file_path = os.fspath(file_path) # the walker yields DirEntry objects
+        logger.debug(f"Scanning: {file_path}")
+        file_abs_path = os.path.abspath(file_path)
+
+        # TODO: add support for non ascii filenames
+        # Only the path under the folder where the script runs counts (the watcher hands over absolute paths)
+        if not file_path.isascii() and not os.path.relpath(file_path).isascii():
+            return IngestResult(file_abs_path, None, None, None, FileTriage.UNSUPPORTED)
+
+        # Ask MediaProcessorFactory for a processor to process the file
+        started = perf_counter()
+        triage = FileTriage.classify(file_path)
+        parsing = perf_counter()
+        metrics.observe("triage", parsing - started)
+        processor = None
+        try:
+            processor = MediaProcessorFactory().create_processor(file_path, triage)
+            capture_date = processor.process(file_path)
+        except MediaProcessor.FileTypeNotSupportedException as e:
+            logger.debug(e)
+            # File could not be processed
+            return IngestResult(file_abs_path, None, None, None, FileTriage.UNSUPPORTED)
+        except MediaProcessor.CouldNotExtractCaptureDateException as e:
+            logger.debug(e)
+            # File could not be processed
+            metrics.count("capture_date.missing")
+            return IngestResult(file_abs_path, None, None, type(processor).__name__, triage.file_format)
+        finally:
+            # Parse latency per extension (of the files that looked like media)
+            extension = os.path.splitext(file_path)[1].lower() if triage.kind else ""
+            metrics.observe(f"parse.{extension.lstrip('.') or 'unsupported'}", perf_counter() - parsing)
+        metrics.count("capture_date.found")
+        return IngestResult(file_abs_path, capture_date[0], capture_date[1], type(processor).__name__, triage.file_format)
+
+
+    # Runs on the ingest workers: hands back the metrics collected while extracting the capture date
+    @staticmethod
+    def extractInWorker(file_path):
+        return Organizer.extractCaptureDate(file_path), metrics.drain()
+
+
+    # Single owner of the ingest results: persists them on the manifest
+    def storeCaptureDate(self, result):
+        self.countFormat(result)
+        if result.date is None:
+            return
+        relativeDate = self.datePlanner.relativeDate(result.date, result.time)
+        self.manifest.write(result.path, result.date, result.time, relativeDate)
+
+
+    def countFormat(self, result):
+        self.formatCounter[result.file_format] = self.formatCounter.get(result.file_format, 0) + 1
+        metrics.tick("ingest")
+
+
+    def reportFormats(self):
+        formats = ", ".join(f"{file_format}: {count}" for file_format, count in sorted(self.formatCounter.items()))
+        logger.info(f"Ingested files per type: {formats or 'none'}.")
+
+
+    def organize(self):
+        dateCounter = self.manifest.dateCounts()
+        if not dateCounter:
+            print ("No files were processed.")
+            self.manifest.delete()
+            return
+
+        metrics.start("move", sum(dateCounter.values()) - len(self.journal.moved))
+
+        # Traverse the manifest (sorted by relative date, i.e. by target folder) to plan each move
+        folders = {relativeDate: self.targetDirectory(relativeDate, count) for relativeDate, count in dateCounter.items()}
+        partitions = {relativeDate: self.targetDirectory(relativeDate, 0) for relativeDate in dateCounter}
+        def planMoves():
+            partition = None
+            for oldFilePath, date, time, relativeDate, newFilename in self.datePlanner.plan(self.manifest.read()):
+                if memoryBudget.enabled and partitions[relativeDate] != partition:
+                    # Low memory mode: the names taken on the folders of the previous month/year are forgotten
+                    partition = partitions[relativeDate]
+                    self.forgetFolders()
+                if oldFilePath in self.journal.moved:
+                    # Moved before the run being resumed was interrupted
+                    continue
+                self.scheduleMove(oldFilePath, newFilename, folders[relativeDate])
+        self.runMoves(planMoves)
+        
+        # After traversing, delete the manifest
+        self.manifest.delete()
+        if self.dedupIndex:
+            logger.info(f"Duplicates not stored again: {self.duplicateCounter}.")
+
+
+    # Watch mode: organizes a batch of new files (the manifest) with the number of files per date of every batch so far
+    def organizeBatch(self, dayCounter):
+        batchCounts = self.manifest.dateCounts()
+        if not batchCounts:
+            return
+        totals = {relativeDate: dayCounter.add(relativeDate, count) for relativeDate, count in batchCounts.items()}
+        # Dates that just got a folder of their own: the files stored before on the monthly/yearly folder join them
+        crossed = {relativeDate for relativeDate, total in totals.items()
+                   if total >= NR_IMAGES_PER_DAY > total - batchCounts[relativeDate]}
+        # The vault may have changed since the last batch
+        self.directoryIndex = {}
+        self.nameCounters = {}
+
+        def planMoves():
+            for oldFilePath, date, time, relativeDate, newFilename in self.datePlanner.plan(self.manifest.read()):
+                newFileLocation = self.targetDirectory(relativeDate, totals[relativeDate])
+                if relativeDate in crossed:
+                    crossed.discard(relativeDate)
+                    for waitingPath, waitingDate, waitingTime in dayCounter.release(relativeDate):
+                        if os.path.exists(waitingPath):
+                            self.scheduleMove(waitingPath, self.datePlanner.filename(waitingDate, waitingTime), newFileLocation)
+                newFilePath = self.scheduleMove(oldFilePath, newFilename, newFileLocation)
+                if newFilePath and totals[relativeDate] < NR_IMAGES_PER_DAY:
+                    dayCounter.wait(relativeDate, newFilePath, date, time)
+        self.runMoves(planMoves)
+        dayCounter.commit()
+
+        # The next batch starts with an empty manifest
+        self.manifest.delete()
+        self.manifest = Manifest.create()
+
+
+    # Runs planMoves (which calls scheduleMove) with the move threads available
+    # Names are resolved right away (so they are deterministic) and the renames run on a thread pool
+    def runMoves(self, planMoves):
+        self.unsubmitted = []
+        self.inFlight = deque()
+        with ThreadPoolExecutor(max_workers=NR_MOVE_THREADS) as self.executor:
+            planMoves()
+            self.drainMoves()
+
+
+    # Plans the move of a file into newFileLocation (named newFilename, or a variant of it) and hands it to the move threads
+    def scheduleMove(self, oldFilePath, newFilename, newFileLocation):
+        fingerprint = None
+        if self.dedupIndex:
+            duplicatePath, fingerprint = self.dedupIndex.lookup(oldFilePath)
+            if duplicatePath:
+                self.storeDuplicate(oldFilePath, duplicatePath)
+                return
+
+        # Calculate the new file name
+        fileExtension = os.path.splitext(oldFilePath)[1]
+        newFilePath = newFileLocation + self.renameWithCaptureDate(newFileLocation, fileExtension, newFilename)
+        if self.dedupIndex:
+            self.dedupIndex.remember(newFilePath, fingerprint, pendingFrom=oldFilePath)
+
+        # Journal the intent of renaming and moving the file (moves only start once their intents are on disk)
+        self.unsubmitted.append((self.journal.intent(oldFilePath, newFilePath), oldFilePath, newFilePath))
+        if len(self.unsubmitted) >= JOURNAL_GROUP_SIZE:
+            self.submitMoves()
+        return newFilePath
+
+
+    # Syncs the journal and hands the moves planned so far to the move threads
+    def submitMoves(self):
+        if not self.unsubmitted:
+            return
+        self.journal.sync()
+        for seq, oldFilePath, newFilePath in self.unsubmitted:
+            self.inFlight.append((self.executor.submit(self.transferEngine.move, oldFilePath, newFilePath), seq, oldFilePath, newFilePath))
+            if len(self.inFlight) >= NR_MOVE_THREADS * MOVES_IN_FLIGHT_PER_THREAD:
+                self.completeMove(*self.inFlight.popleft())
+        self.unsubmitted = []
+
+
+    def drainMoves(self):
+        self.submitMoves()
+        while self.inFlight:
+            self.completeMove(*self.inFlight.popleft())
+
+
+    # Waits for a move and journals it (moves are completed in the order they were planned)
+    def completeMove(self, move, seq, oldFilePath, newFilePath):
+        try:
+            strategy = move.result()
+        except OSError as e:
+            logger.error(f"Unable to move {oldFilePath} to {newFilePath} due to: {str(e)}.")
+            self.journal.abort(seq)
+            if self.dedupIndex:
+                self.dedupIndex.forget(newFilePath)
+            return
+        self.journal.commit(seq, strategy)
+        metrics.tick("move")
+        self.metadataCache.relocate(oldFilePath, newFilePath)
+        if self.dedupIndex:
+            self.dedupIndex.settle(newFilePath)
+
+
+    # Skips a file whose content is already stored on duplicatePath (or replaces it by a hard link to it)
+    def storeDuplicate(self, oldFilePath, duplicatePath):
+        self.duplicateCounter += 1
+        if DEDUPLICATE == "hardlink" and not self.isSameFile(oldFilePath, duplicatePath):
+            if self.dedupIndex.isPending(duplicatePath):
+                # The copy on the processedFolder is still being moved
+                self.drainMoves()
+            try:
+                os.link(duplicatePath, oldFilePath + TransferEngine.PARTIAL_SUFFIX)
+                os.replace(oldFilePath + TransferEngine.PARTIAL_SUFFIX, oldFilePath)
+                logger.debug(f"Replaced {oldFilePath} by a hard link to {duplicatePath}")
+                return
+            except OSError as e:
+                logger.debug(f"Unable to hard link {oldFilePath} to {duplicatePath} due to: {str(e)}.")
+                if os.path.exists(oldFilePath + TransferEngine.PARTIAL_SUFFIX):
+                    os.remove(oldFilePath + TransferEngine.PARTIAL_SUFFIX)
+        logger.debug(f"Skipped {oldFilePath}, its content is already stored on {duplicatePath}")
+
+
+    @staticmethod
+    def isSameFile(file_path, other_file_path):
+        try:
+            return os.path.samefile(file_path, other_file_path)
+        except OSError:
+            return False
+
+
+    # Returns the folder where files of relativeDate should be placed (given the number of files of that date)
+    def targetDirectory(self, relativeDate, dateCount):
+        relativeYear  = relativeDate[:4]
+        relativeMonth = relativeDate[5:7]
+        if(MONTHLY_PARTITION):
+            newFileLocation = self.processedFolder + relativeYear + "/" + relativeMonth + "/"  # .../YYYY/MM
+        else:
+            newFileLocation = self.processedFolder + relativeYear + "/"     # .../YYYY
+        if dateCount >= NR_IMAGES_PER_DAY:
+            newFileLocation += relativeDate + "/"                       # .../YYYY/MM/YYYY.MM.DD
+        return newFileLocation
+
+
+    # Forgets the names taken on the target folders (their moves are completed first, so listing them again is accurate)
+    def forgetFolders(self):
+        self.drainMoves()
+        self.directoryIndex = {}
+        self.nameCounters = {}
+
+
+    # Returns the names taken on a folder, creating it and listing its content on the first call
+    def takenNames(self, folder):
+        names = self.directoryIndex.get(folder)
+        if names is None:
+            started = perf_counter()
+            os.makedirs(folder, exist_ok=True)
+            metrics.observe("move.makedirs", perf_counter() - started)
+            with os.scandir(folder) as entries:
+                names = {entry.name.lower() for entry in entries}
+            self.directoryIndex[folder] = names
+        return names
+
+
+    # Settles the moves the interrupted run had started: the ones that went through are committed, the others aborted
+    def recover(self):
+        for seq, (oldFilePath, newFilePath) in list(self.journal.intents.items()):
+            if os.path.exists(newFilePath) and (not os.path.exists(oldFilePath) or self.isCopy(newFilePath, oldFilePath)):
+                # A copy across file systems may have been interrupted before its source was deleted
+                if os.path.exists(oldFilePath):
+                    os.remove(oldFilePath)
+                self.journal.commit(seq, Journal.RECOVERED)
+                # Moved before the run was interrupted, so organize() must skip it as well
+                self.journal.moved.add(oldFilePath)
+            else:
+                if os.path.exists(newFilePath + TransferEngine.PARTIAL_SUFFIX):
+                    os.remove(newFilePath + TransferEngine.PARTIAL_SUFFIX)
+                self.journal.abort(seq)
+        self.journal.sync()
+
+
+    # Whether copyPath holds the same content as file_path (and is not the same file)
+    @staticmethod
+    def isCopy(copyPath, file_path):
+        try:
+            return os.path.getsize(copyPath) == os.path.getsize(file_path) and not Organizer.isSameFile(copyPath, file_path) \
+                and TransferEngine.hash(copyPath) == TransferEngine.hash(file_path)
+        except OSError:
+            return False
+
+
+    def close(self):
+        self.journal.close()
+        metrics.count("cache.hits", self.metadataCache.hits)
+        metrics.count("cache.misses", self.metadataCache.misses)
+        self.metadataCache.close()
+        metrics.end(self.journal.runId, self.metricsFile)
+        memoryBudget.report()
+        if self.dedupIndex:
+            self.dedupIndex.close()
+        self.transferEngine.report()
+
+
+    # Responsible for returning the new file name (newFilename comes from the DatePlanner)
+    def renameWithCaptureDate(self, newFileLocation, fileExtension, newFilename):
+        # Find a unique filename (to ensure we avoid overriding on the newFileLocation)
+        # Names are compared in lowercase as the folder might live on a case insensitive file system
+        takenNames = self.takenNames(newFileLocation)
+        counterKey = (newFileLocation, f"{newFilename}{fileExtension}".lower())
+        counter = self.nameCounters.get(counterKey, 0) # 0 stands for the name without a counter
+        while True:
+            newUniqueFilename = f"{newFilename} ({counter}){fileExtension}" if counter else f"{newFilename}{fileExtension}"
+            if newUniqueFilename.lower() not in takenNames:
+                break
+            counter += 1
+            metrics.count("move.collision_probes")
+        takenNames.add(newUniqueFilename.lower())
+        self.nameCounters[counterKey] = counter + 1
+
+        return newUniqueFilename
+
+
+
+##################################################################
+# DATE PLANNER
+##################################################################
+class DatePlanner():
+    '''
+    Computes relative dates (see WEE_SMALL_HOURS_OF_THE_MORNING) and new file names without a strptime/strftime per file.
+    DATE_FORMAT and TIME_FORMAT are compiled once into regexes, and each distinct date and time is only parsed once
+    (into a day ordinal and the seconds of the day). OUTPUT_FORMAT is compiled into a template, which is rendered once
+    per day (leaving the time out). Formats using directives other than %Y %m %d %H %M %S fall back to strptime/strftime
+    '''
+    # directive --> (field, regex)
+    DIRECTIVES = {
+        'Y': ('year',   r'\d{4}'),
+        'm': ('month',  r'\d{1,2}'),
+        'd': ('day',    r'\d{1,2}'),
+        'H': ('hour',   r'\d{1,2}'),
+        'M': ('minute', r'\d{1,2}'),
+        'S': ('second', r'\d{1,2}'),
+    }
+    TIME_FIELDS = ('hour', 'minute', 'second')
+
+    def __init__(self):
+        self.dateParser = DatePlanner.compileParser(DATE_FORMAT)
+        self.timeParser = DatePlanner.compileParser(TIME_FORMAT)
+        self.outputTemplate = DatePlanner.compileTemplate(OUTPUT_FORMAT)
+        self.endOfDay = self.parseSeconds(WEE_SMALL_HOURS_OF_THE_MORNING)
+        # days/seconds --> date/time string --> day ordinal/seconds of the day
+        # relativeDates/dayTemplates --> day ordinal --> relative date string/OUTPUT_FORMAT with the date filled in
+        self.days = {}
+        self.seconds = {}
+        self.relativeDates = {}
+        self.dayTemplates = {}
+        # dates/times --> day ordinal/seconds of the day --> date/time string (in DATE_FORMAT/TIME_FORMAT)
+        self.dates = {}
+        self.times = {}
+
+    # Returns a regex with a named group per directive of format (None if format has other directives)
+    @staticmethod
+    def compileParser(format):
+        pattern = ""
+        for n, part in enumerate(re.split(r'(%.)', format)):
+            if n % 2 == 0:
+                pattern += re.escape(part)
+            elif part == "%%":
+                pattern += "%"
+            elif part[1] in DatePlanner.DIRECTIVES:
+                field, regex = DatePlanner.DIRECTIVES[part[1]]
+                pattern += f"(?P={field})" if f"(?P<{field}>" in pattern else f"(?P<{field}>{regex})"
+            else:
+                return None
+        return re.compile(pattern)
+
+    # Returns a %-template of format to be filled in twice: first the date, then the time (None if format has other directives)
+    @staticmethod
+    def compileTemplate(format):
+        template = ""
+        for n, part in enumerate(re.split(r'(%.)', format)):
+            if n % 2 == 0:
+                template += part.replace("%", "%%%%")
+            elif part == "%%":
+                template += "%%%%"
+            elif part[1] in DatePlanner.DIRECTIVES:
+                field = DatePlanner.DIRECTIVES[part[1]][0]
+                width = 4 if field == 'year' else 2
+                template += f"%%({field})0{width}d" if field in DatePlanner.TIME_FIELDS else f"%({field})0{width}d"
+            else:
+                return None
+        return template
+
+    # Returns the day ordinal of a date (in DATE_FORMAT)
+    def parseDate(self, date):
+        day = self.days.get(date)
+        if day is None:
+            match = self.dateParser.fullmatch(date) if self.dateParser else None
+            if match:
+                day = datetime(int(match["year"]), int(match["month"]), int(match["day"])).toordinal()
+            else:
+                day = datetime.strptime(date, DATE_FORMAT).toordinal()
+            self.days[date] = day
+        return day
+
+    # Returns the seconds of the day of a time (in TIME_FORMAT)
+    def parseTime(self, time):
+        seconds = self.seconds.get(time)
+        if seconds is None:
+            seconds = self.seconds[time] = self.parseSeconds(time)
+        return seconds
+
+    def parseSeconds(self, time):
+        match = self.timeParser.fullmatch(time) if self.timeParser else None
+        if match:
+            hour, minute, second = int(match["hour"]), int(match["minute"]), int(match["second"])
+            if hour > 23 or minute > 59 or second > 61:
+                raise ValueError(f"Invalid time: {time}")
+        else:
+            parsed = datetime.strptime(time, TIME_FORMAT)
+            hour, minute, second = parsed.hour, parsed.minute, parsed.second
+        return hour * 3600 + minute * 60 + second
+
+    # Responsible for the logic of WEE_SMALL_HOURS_OF_THE_MORNING: files taken before it belong to the previous day
+    def relativeDate(self, date, time):
+        # if time is not available, don't perform any computation, just return the date
+        if not time:
+            return date
+        return self.renderRelativeDate(self.parseDate(date) - (self.parseTime(time) < self.endOfDay))
+
+    def renderRelativeDate(self, day):
+        relativeDate = self.relativeDates.get(day)
+        if relativeDate is None:
+            relativeDate = self.relativeDates[day] = datetime.fromordinal(day).strftime("%Y.%m.%d")
+        return relativeDate
+
+    # Returns the new file name (without its extension) of a file captured on date and time
+    def filename(self, date, time):
+        if not time:
+            return date
+        return self.render(self.parseDate(date), self.parseTime(time))
+
+    def render(self, day, seconds):
+        if self.outputTemplate is None:
+            return (datetime.fromordinal(day) + timedelta(seconds=seconds)).strftime(OUTPUT_FORMAT)
+        dayTemplate = self.dayTemplates.get(day)
+        if dayTemplate is None:
+            captureDay = datetime.fromordinal(day)
+            dayTemplate = self.outputTemplate % {"year": captureDay.year, "month": captureDay.month, "day": captureDay.day}
+            self.dayTemplates[day] = dayTemplate
+        return dayTemplate % {"hour": seconds // 3600, "minute": seconds // 60 % 60, "second": seconds % 60}
+
+    # Packs a capture date and time into an integer (day ordinal * 86400 + seconds of the day, or -day ordinal if there is
+    # no time). Returns None if they would not be rendered back the same (e.g. a date with no leading zeros)
+    def pack(self, date, time):
+        try:
+            day = self.parseDate(date)
+            seconds = self.parseTime(time) if time else None
+        except ValueError:
+            return None
+        if self.renderDate(day) != date or (time and self.renderTime(seconds) != time):
+            return None
+        return -day if seconds is None else day * 86400 + seconds
+
+    # Returns the (date, time) packed by pack()
+    def unpack(self, packed):
+        if packed < 0:
+            return self.renderDate(-packed), None
+        day, seconds = divmod(packed, 86400)
+        return self.renderDate(day), self.renderTime(seconds)
+
+    def renderDate(self, day):
+        date = self.dates.get(day)
+        if date is None:
+            date = self.dates[day] = datetime.fromordinal(day).strftime(DATE_FORMAT)
+        return date
+
+    def renderTime(self, seconds):
+        time = self.times.get(seconds)
+        if time is None:
+            time = self.times[seconds] = (datetime.min + timedelta(seconds=seconds)).strftime(TIME_FORMAT)
+        return time
+
+    # Yields the manifest rows (oldFilePath, date, time, relativeDate) along with the new file name of each file
+    def plan(self, rows):
+        for row in rows:
+            yield (*row, self.filename(row[1], row[2]))
+
+
+
+##################################################################
+# METRICS
+##################################################################
+class Metrics():
+    '''
+    Counters and latency histograms of every stage (walk, triage, parsers, manifest, moves), a periodic progress line
+    and an end of run report. The ingest workers hand the metrics they collect back with each result.
+    Histograms keep power of two buckets (in microseconds), hence their percentiles are upper bounds
+    '''
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {} # name --> [count, total seconds, max seconds, {bucket: count}]
+        self.started = perf_counter()
+        self.stages = {} # stage --> [started, last file done at, files done, files expected or None]
+        self.lastProgress = perf_counter()
+
+    # Worker processes start from a clean slate (a forked worker would otherwise inherit the parent's metrics)
+    @staticmethod
+    def initWorker():
+        metrics.reset()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0, 0.0, 0.0, {}]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+            histogram[3][bucket] = histogram[3].get(bucket, 0) + 1
+
+    # Returns (and forgets) the metrics collected so far
+    def drain(self):
+        with self.lock:
+            drained = (self.counters, self.histograms)
+            self.counters, self.histograms = {}, {}
+        return drained
+
+    def merge(self, drained):
+        counters, histograms = drained
+        with self.lock:
+            for name, n in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, (count, total, maximum, buckets) in histograms.items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = [0, 0.0, 0.0, {}]
+                histogram[0] += count
+                histogram[1] += total
+                histogram[2] = max(histogram[2], maximum)
+                for bucket, n in buckets.items():
+                    histogram[3][bucket] = histogram[3].get(bucket, 0) + n
+
+    # Starts timing a stage (otherwise it starts with its first file)
+    def start(self, stage, total=None):
+        self.stages[stage] = [perf_counter(), perf_counter(), 0, total]
+
+    # Counts a file done by a stage and prints the progress line when it is due
+    def tick(self, stage):
+        now = perf_counter()
+        progress = self.stages.get(stage)
+        if progress is None:
+            progress = self.stages[stage] = [now, now, 0, None]
+        progress[1] = now
+        progress[2] += 1
+        if PROGRESS_INTERVAL and now - self.lastProgress >= PROGRESS_INTERVAL:
+            self.lastProgress = now
+            self.printProgress(stage, *progress)
+            for hook in METRICS_HOOKS:
+                hook("progress", self.report())
+
+    def printProgress(self, stage, started, last, done, total):
+        rate = done / max(last - started, 1e-9)
+        line = f"[{stage}] {done}{f' of {total}' if total else ''} files | {rate:.0f} files/s"
+        if total and rate:
+            line += f" | ETA {timedelta(seconds=round(max(total - done, 0) / rate))}"
+        print(line, file=sys.stderr, flush=True)
+
+    def report(self, runId=None):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: self.summarize(*histogram) for name, histogram in sorted(self.histograms.items())}
+        attempts = counters.get("lucky.attempts", 0)
+        return {
+            "run": runId,
+            "seconds": round(perf_counter() - self.started, 3),
+            "stages": {stage: {"files": done, "seconds": round(last - started, 3), "files_per_sec": round(done / max(last - started, 1e-9), 1)}
+                       for stage, (started, last, done, total) in self.stages.items()},
+            "lucky_hit_rate": round(counters.get("lucky.hits", 0) / attempts, 4) if attempts else None,
+            "peak_rss_mb": MemoryBudget.peakRss(),
+            "counters": dict(sorted(counters.items())),
+            "histograms": histograms,
+        }
+
+    @staticmethod
+    def summarize(count, total, maximum, buckets):
+        summary = {"count": count, "total_s": round(total, 6), "mean_ms": round(total / count * 1000, 3), "max_ms": round(maximum * 1000, 3)}
+        seen = 0
+        percentiles = list(Metrics.PERCENTILES)
+        for bucket in sorted(buckets):
+            seen += buckets[bucket]
+            while percentiles and seen >= count * percentiles[0] / 100:
+                # Upper bound of the bucket (2 ** bucket microseconds), never above the maximum seen
+                summary[f"p{percentiles.pop(0)}_ms"] = round(min(2 ** bucket / 1000, maximum * 1000), 3)
+        return summary
+
+    # Saves the report, hands it to the hooks and logs a summary of it
+    def end(self, runId, reportFile):
+        report = self.report(runId)
+        if reportFile:
+            with open(reportFile, "w") as file:
+                json.dump(report, file, indent=2)
+        for hook in METRICS_HOOKS:
+            hook("end", report)
+        for stage, progress in report["stages"].items():
+            logger.info(f"{stage}: {progress['files']} files ({progress['files_per_sec']} files/s).")
+        for name, summary in report["histograms"].items():
+            logger.debug(f"{name}: {summary}")
+
+metrics = Metrics()
+
+
+
+##################################################################
+# MEMORY BUDGET
+##################################################################
+class MemoryBudget():
+    '''
+    Low memory mode (see LOW_MEMORY): hands out shares of MEMORY_LIMIT to the buffers that would otherwise grow
+    with the number of files, and measures the peak memory usage (RSS) of the run
+    '''
+    # Share of MEMORY_LIMIT given to each buffer (the rest is left to the interpreter, the sqlite databases and the moves)
+    SHARES = {"sort": 0.25, "paths": 0.05}
+    MIN_SHARE = 8 * 1024 * 1024 # Bytes a buffer is not shrunk below while the memory usage is over MEMORY_LIMIT
+    CHECK_INTERVAL = 4096 # Items added to a buffer between checks of the memory usage
+
+    def __init__(self):
+        self.enabled = LOW_MEMORY
+        self.limit = MEMORY_LIMIT
+        self.degraded = set()
+
+    def enable(self):
+        self.enabled = True
+
+    # Bytes given to a buffer (None outside of the low memory mode, where buffers are not bounded)
+    def share(self, name):
+        if not self.enabled:
+            return None
+        return int(self.limit * 1024 * 1024 * MemoryBudget.SHARES[name])
+
+    # Returns an empty set of paths: a regular set, or a PathSet in low memory mode
+    def pathSet(self):
+        return PathSet(self.share("paths")) if self.enabled else set()
+
+    # Returns the bytes a buffer of size bytes gets from now on: half of them (down to MIN_SHARE) while the memory usage
+    # is over MEMORY_LIMIT, so that it is spilled to disk earlier
+    def degrade(self, name, size):
+        if size <= MemoryBudget.MIN_SHARE:
+            return size
+        rss = MemoryBudget.rss()
+        if rss is None or rss <= self.limit:
+            return size
+        if name not in self.degraded:
+            self.degraded.add(name)
+            logger.warning(f"Memory usage ({rss} MB) went over MEMORY_LIMIT ({self.limit} MB). Shrinking the {name} buffer.")
+        metrics.count(f"memory.degraded.{name}")
+        return max(size // 2, MemoryBudget.MIN_SHARE)
+
+    # Resident set size of the process in MB (the peak one where the current one can not be measured)
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as file: # Only on Linux
+                pages = int(file.read().split()[1])
+            return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+        except (OSError, ValueError, AttributeError):
+            return MemoryBudget.peakRss()
+
+    # Peak resident set size of the process in MB (None where it can not be measured)
+    @staticmethod
+    def peakRss():
+        try:
+            import resource # Not available on Windows
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+    def report(self):
+        peak = MemoryBudget.peakRss()
+        if peak is None:
+            return
+        logger.info(f"Peak memory usage: {peak} MB.")
+        if self.enabled and peak > self.limit:
+            logger.warning(f"Peak memory usage ({peak} MB) went over MEMORY_LIMIT ({self.limit} MB).")
+
+memoryBudget = MemoryBudget()
+
+
+
+##################################################################
+# MEMORY BUDGET >> PATH SET
+##################################################################
+class PathSet():
+    '''
+    Set of paths on a private temporary sqlite database (deleted once closed), for the low memory mode.
+    It only supports what the sets of paths are used for: add, update, in and len
+    '''
+    def __init__(self, cacheBytes):
+        self.connection = sqlite3.connect("")
+        self.connection.execute(f"PRAGMA cache_size = -{max(cacheBytes // 1024, 1024)}")
+        self.connection.execute("CREATE TABLE paths (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.buffer = []
+
+    def add(self, path):
+        self.buffer.append((path,))
+        if len(self.buffer) >= MANIFEST_BATCH_SIZE:
+            self.flush()
+
+    def update(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def flush(self):
+        if self.buffer:
+            self.connection.executemany("INSERT OR IGNORE INTO paths VALUES (?)", self.buffer)
+            self.buffer = []
+
+    def __contains__(self, path):
+        self.flush()
+        return self.connection.execute("SELECT 1 FROM paths WHERE path = ?", (path,)).fetchone() is not None
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute("SELECT COUNT(*) FROM paths").fetchone()[0]
+
+
+
+##################################################################
+# DAY COUNTER
+##################################################################
+class DayCounter():
+    '''
+    Persistent number of files per relative date, for the watch mode: files arrive in small batches, so whether a date
+    gets a folder of its own (NR_IMAGES_PER_DAY) is decided on the files of every batch so far. The files of the dates
+    without a folder yet are remembered, to be moved into it once the date gets one.
+    The counts are built once from the names of the files already in the vault
+    '''
+    def __init__(self, counterFile, organizer):
+        self.connection = sqlite3.connect(counterFile)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS days (relative_date TEXT PRIMARY KEY, count INTEGER)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS waiting (
+            path TEXT PRIMARY KEY, relative_date TEXT, capture_date TEXT, capture_time TEXT)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS waiting_relative_date ON waiting (relative_date)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS built (folder TEXT)")
+        if self.connection.execute("SELECT folder FROM built").fetchone() is None:
+            self.build(organizer)
+        self.connection.commit()
+
+
+    # Counts the files already stored in the vault (only runs once), from the names given by renameWithCaptureDate
+    # e.g. "2023.01.05 (10h00m00s) (1).jpg" or "2023.01.05 (1).jpg"
+    def build(self, organizer):
+        logger.info("Counting the files per date of the _Media Vault folder.")
+        storedName = re.compile(r"(\d{4}\.\d{2}\.\d{2})(?: \((\d{2})h(\d{2})m(\d{2})s\))?(?: \(\d+\))?\.[^.]+")
+        counts = {}
+        waiting = []
+        for root, dirs, files in os.walk(organizer.processedFolder):
+            for filename in files:
+                match = storedName.fullmatch(filename)
+                if not match:
+                    continue
+                date = match.group(1)
+                time = ".".join(match.group(2, 3, 4)) if match.group(2) else None
+                relativeDate = organizer.datePlanner.relativeDate(date, time)
+                counts[relativeDate] = counts.get(relativeDate, 0) + 1
+                if os.path.join(root, "") == organizer.targetDirectory(relativeDate, 0):
+                    waiting.append((os.path.join(root, filename), relativeDate, date, time))
+        self.connection.executemany("INSERT INTO days VALUES (?, ?)", counts.items())
+        self.connection.executemany("INSERT INTO waiting VALUES (?, ?, ?, ?)",
+                                    (row for row in waiting if counts[row[1]] < NR_IMAGES_PER_DAY))
+        self.connection.execute("INSERT INTO built VALUES (?)", (organizer.processedFolder,))
+
+
+    # Adds count files to a relative date and returns its total
+    def add(self, relativeDate, count):
+        row = self.connection.execute("SELECT count FROM days WHERE relative_date = ?", (relativeDate,)).fetchone()
+        total = (row[0] if row else 0) + count
+        self.connection.execute("INSERT OR REPLACE INTO days VALUES (?, ?)", (relativeDate, total))
+        return total
+
+
+    # Remembers a file stored on the monthly/yearly folder
+    def wait(self, relativeDate, path, date, time):
+        self.connection.execute("INSERT OR REPLACE INTO waiting VALUES (?, ?, ?, ?)", (path, relativeDate, date, time))
+
+
+    # Returns (and forgets) the (path, date, time) of the files of a relative date stored on the monthly/yearly folder
+    def release(self, relativeDate):
+        rows = self.connection.execute(
+            "SELECT path, capture_date, capture_time FROM waiting WHERE relative_date = ? ORDER BY capture_date, capture_time",
+            (relativeDate,)).fetchall()
+        self.connection.execute("DELETE FROM waiting WHERE relative_date = ?", (relativeDate,))
+        return rows
+
+
+    def commit(self):
+        self.connection.commit()
+
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+
+##################################################################
+# WATCHER
+##################################################################
+class Watcher(ABC):
+    '''
+    Watches a folder (and its subfolders) for new or changed files. A file is only handed over once its size and
+    modification time have not changed for WATCH_SETTLE_TIME seconds, so half written files are left alone.
+    Files already there when the watch starts are handed over as well
+    '''
+    IGNORED_SUFFIXES = (".partial", ".part", ".crdownload", ".tmp", "-journal", "-wal", "-shm")
+    TICK = 0.1 # Seconds between checks of the files settling down
+
+    def __init__(self, folder, ignoredFolder, ignoredFiles):
+        self.folder = folder
+        self.ignoredFolder = ignoredFolder
+        self.ignoredFiles = ignoredFiles
+        # pending --> path --> ((size, mtime), since when) or None if it was not checked yet
+        self.pending = {}
+
+    # Returns an inotify watcher where available, a polling one otherwise
+    @staticmethod
+    def create(folder, ignoredFolder, ignoredFiles):
+        try:
+            watcher = InotifyWatcher(folder, ignoredFolder, ignoredFiles)
+        except OSError as e:
+            logger.info(f"inotify is not available ({str(e)}), polling instead.")
+            watcher = PollingWatcher(folder, ignoredFolder, ignoredFiles)
+        watcher.rescan()
+        return watcher
+
+    def ignored(self, path):
+        name = os.path.basename(path)
+        if (name.startswith(".") or name.endswith(Watcher.IGNORED_SUFFIXES) or path in self.ignoredFiles
+                or path == self.ignoredFolder or path.startswith(self.ignoredFolder + os.sep)):
+            return True
+        # IGNORE_GLOBS, on the path and on each of the folders it is in (as the walker never lists those)
+        parts = os.path.relpath(path, self.folder).split(os.sep)
+        return any(Walker.ignored(part, os.sep.join(parts[:n + 1])) for n, part in enumerate(parts))
+
+    def notice(self, path):
+        if not self.ignored(path):
+            self.pending[path] = None
+
+    # Notices every file under a folder (on start, when a folder shows up and when events were lost)
+    def rescan(self, folder=None):
+        folders = [folder or self.folder]
+        while folders:
+            current = folders.pop()
+            self.watchFolder(current)
+            try:
+                with os.scandir(current) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+            for entry in entries:
+                if self.ignored(entry.path):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if TRAVERSE_SUBDIRS:
+                        folders.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    self.found(entry)
+
+    def watchFolder(self, folder):
+        pass
+
+    def found(self, entry):
+        self.notice(entry.path)
+
+    @abstractmethod
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds (None = until something happens) and notice the files that changed.
+        """
+        pass
+
+    def close(self):
+        pass
+
+    # Yields the files that settled down, in batches
+    def batches(self):
+        while True:
+            ready = self.settle()
+            if ready:
+                yield ready
+            self.poll(Watcher.TICK if self.pending else None)
+
+    def settle(self):
+        now = perf_counter()
+        ready = []
+        for path, state in list(self.pending.items()):
+            try:
+                fileStat = os.stat(path)
+            except OSError:
+                # Gone (e.g. moved away by whoever was writing it)
+                del self.pending[path]
+                continue
+            if not stat.S_ISREG(fileStat.st_mode):
+                del self.pending[path]
+                continue
+            signature = (fileStat.st_size, fileStat.st_mtime_ns)
+            if state is None or state[0] != signature:
+                self.pending[path] = (signature, now)
+            elif now - state[1] >= WATCH_SETTLE_TIME:
+                ready.append(path)
+                del self.pending[path]
+        return sorted(ready)
+
+
+
+##################################################################
+# WATCHER >> INOTIFY WATCHER
+##################################################################
+class InotifyWatcher(Watcher):
+    '''
+    Linux inotify (through ctypes): one watch per folder, events are read as they come
+    '''
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct("iIII") # wd, mask, cookie, len (followed by the name)
+
+    def __init__(self, folder, ignoredFolder, ignoredFiles):
+        super().__init__(folder, ignoredFolder, ignoredFiles)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify_init1 is missing from libc")
+        self.libc = libc
+        self.fd = libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.folders = {} # watch descriptor --> folder
+
+    def watchFolder(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), InotifyWatcher.MASK)
+        if wd < 0:
+            logger.warning(f"Unable to watch {folder} due to: {os.strerror(ctypes.get_errno())}.")
+            return
+        self.folders[wd] = folder
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = InotifyWatcher.EVENT.unpack_from(data, offset)
+            name = data[offset + InotifyWatcher.EVENT.size:offset + InotifyWatcher.EVENT.size + length].rstrip(b"\0")
+            offset += InotifyWatcher.EVENT.size + length
+            if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                self.rescan()
+                continue
+            if mask & InotifyWatcher.IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, os.fsdecode(name))
+            if mask & InotifyWatcher.IN_ISDIR:
+                # A new folder: watch it and pick up whatever landed on it before the watch
+                if TRAVERSE_SUBDIRS and not self.ignored(path):
+                    self.rescan(path)
+            else:
+                self.notice(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+##################################################################
+# WATCHER >> POLLING WATCHER
+##################################################################
+class PollingWatcher(Watcher):
+    '''
+    Portable fallback: rescans the folder every WATCH_POLL_INTERVAL seconds and notices the files whose size or
+    modification time changed since the previous scan
+    '''
+    def __init__(self, folder, ignoredFolder, ignoredFiles):
+        super().__init__(folder, ignoredFolder, ignoredFiles)
+        self.signatures = {} # path --> (size, mtime) on the last scan
+        self.present = set()
+        self.lastScan = 0
+
+    def found(self, entry):
+        fileStat = entry.stat(follow_symlinks=False)
+        signature = (fileStat.st_size, fileStat.st_mtime_ns)
+        self.present.add(entry.path)
+        if self.signatures.get(entry.path) != signature:
+            self.signatures[entry.path] = signature
+            self.notice(entry.path)
+
+    def rescan(self, folder=None):
+        self.present = set()
+        self.lastScan = perf_counter()
+        super().rescan(folder)
+        for path in self.signatures.keys() - self.present:
+            del self.signatures[path]
+
+    def poll(self, timeout):
+        sleep(WATCH_POLL_INTERVAL if timeout is None else timeout)
+        if perf_counter() - self.lastScan >= WATCH_POLL_INTERVAL:
+            self.rescan()
+
+
+
+##################################################################
+# JOURNAL
+##################################################################
+class Journal():
+    '''
+    Append-only journal (one JSON record per line) of every run and every move:
+    an "intent" record is written before a file is moved and a "commit" (or "abort") record once it was.
+    Records are fsync'ed in groups, before a batch of moves starts, instead of once per file.
+    An interrupted run can be resumed: intents without a commit are checked against the file system.
+    A sidecar index (_journal.idx) keeps the offset where each run starts, so a run can be read without scanning the whole history
+    '''
+    RECOVERED = "recovered"
+    IndexEntry = namedtuple("IndexEntry", ["offset", "kind", "run", "time"])
+    INDEXED_RECORDS = (b'{"type": "start"', b'{"type": "resume"', b'{"type": "revert"')
+
+    def __init__(self, journalFile):
+        self.journalFile = journalFile
+        self.file = None
+        self.runId = None
+        self.seq = 0
+        # State of the run: whether the ingest is over, the files already moved and the moves not yet settled
+        self.ingested = False
+        self.moved = memoryBudget.pathSet()
+        self.intents = {}
+
+    def start(self, resume=False):
+        if resume:
+            self.load()
+        else:
+            self.runId = datetime.now().strftime("%Y%m%d-%H%M%S-") + str(os.getpid())
+        self.file = open(self.journalFile, "a", encoding="utf-8")
+        offset = self.file.tell()
+        kind, time = "resume" if resume else "start", datetime.now().isoformat(timespec="seconds")
+        self.write({"type": kind, "time": time, "folder": os.getcwd()})
+        self.sync()
+        Journal.addToIndex(self.journalFile, Journal.IndexEntry(offset, kind, self.runId, time))
+
+    # Loads the state of the last run, which must not have ended
+    def load(self):
+        if os.path.exists(self.journalFile):
+            starts = [entry.offset for entry in Journal.readIndex(self.journalFile) if entry.kind == "start"]
+            for record in Journal.records(self.journalFile, starts[-1] if starts else 0):
+                if record["type"] == "start":
+                    self.runId, self.seq, self.ingested, self.moved, self.intents = record["run"], 0, False, memoryBudget.pathSet(), {}
+                if record["run"] != self.runId:
+                    continue
+                if record["type"] == "intent":
+                    self.intents[record["seq"]] = (record["old"], record["new"])
+                    self.seq = max(self.seq, record["seq"])
+                elif record["type"] == "commit":
+                    self.moved.add(self.intents.pop(record["seq"])[0])
+                elif record["type"] == "abort":
+                    self.intents.pop(record["seq"], None)
+                elif record["type"] == "ingested":
+                    self.ingested = True
+                elif record["type"] == "end":
+                    self.runId = None
+        if self.runId is None:
+            logger.error("There is no interrupted run to resume.")
+            sys.exit(1)
+        logger.info(f"Resuming run {self.runId}: {len(self.moved)} files were already moved.")
+
+    # Returns the types of the records of the last run of a journal (empty if there is none)
+    @staticmethod
+    def lastRunRecords(journalFile):
+        types = set()
+        if not os.path.exists(journalFile):
+            return types
+        starts = [entry.offset for entry in Journal.readIndex(journalFile) if entry.kind == "start"]
+        runId = None
+        for record in Journal.records(journalFile, starts[-1] if starts else 0):
+            if record["type"] == "start":
+                runId, types = record["run"], set()
+            if record["run"] == runId:
+                types.add(record["type"])
+        return types
+
+    # Yields every record of a journal from the given offset on (a torn last line, left by a crash, is ignored)
+    @staticmethod
+    def records(journalFile, offset=0):
+        with open(journalFile, "rb") as file:
+            file.seek(offset)
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    # Yields the lines of a file between two offsets, last line first, reading it backwards block by block
+    @staticmethod
+    def reversedLines(path, start=0, end=None):
+        with open(path, "rb") as file:
+            position = file.seek(0, os.SEEK_END) if end is None else end
+            tail = b""
+            while position > start:
+                size = min(TRANSFER_BUFFER_SIZE, position - start)
+                position -= size
+                file.seek(position)
+                lines = (file.read(size) + tail).split(b"\n")
+                tail = lines.pop(0)
+                for line in reversed(lines):
+                    if line:
+                        yield line
+            if tail:
+                yield tail
+
+    @staticmethod
+    def indexFile(journalFile):
+        return os.path.splitext(journalFile)[0] + ".idx"
+
+    @staticmethod
+    def addToIndex(journalFile, entry):
+        if entry.offset and not os.path.exists(Journal.indexFile(journalFile)):
+            # Journal written before the index existed (the new entry is picked up when it is rebuilt)
+            Journal.rebuildIndex(journalFile)
+            return
+        with open(Journal.indexFile(journalFile), "a", encoding="utf-8") as file:
+            file.write("\t".join(str(field) for field in entry) + "\n")
+
+    # Returns the entries of the index, rebuilding it if it is missing or does not match the journal
+    @staticmethod
+    def readIndex(journalFile):
+        entries = []
+        if os.path.exists(Journal.indexFile(journalFile)):
+            with open(Journal.indexFile(journalFile), "r", encoding="utf-8") as file:
+                for line in file:
+                    offset, kind, run, time = line.rstrip("\n").split("\t")
+                    entries.append(Journal.IndexEntry(int(offset), kind, run, time))
+        if not entries or entries[-1].offset >= os.path.getsize(journalFile):
+            entries = Journal.rebuildIndex(journalFile)
+        return entries
+
+    @staticmethod
+    def rebuildIndex(journalFile):
+        entries = []
+        with open(journalFile, "rb") as file:
+            offset = 0
+            for line in file:
+                if line.startswith(Journal.INDEXED_RECORDS):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    entries.append(Journal.IndexEntry(offset, record["type"], record["run"], record["time"]))
+                offset += len(line)
+        with open(Journal.indexFile(journalFile), "w", encoding="utf-8") as file:
+            for entry in entries:
+                file.write("\t".join(str(field) for field in entry) + "\n")
+        return entries
+
+    # Yields the (old path, new path) of the committed moves of a run, last move first
+    @staticmethod
+    def committedMoves(journalFile, runId, entries):
+        # The byte ranges of the run (it may have been resumed)
+        ranges = []
+        for index, entry in enumerate(entries):
+            if entry.run == runId and entry.kind != "revert":
+                ranges.append((entry.offset, entries[index + 1].offset if index + 1 < len(entries) else None))
+        commits = set()
+        for start, end in reversed(ranges):
+            for line in Journal.reversedLines(journalFile, start, end):
+                if line.startswith(b'{"type": "commit"'):
+                    commits.add(json.loads(line)["seq"])
+                elif line.startswith(b'{"type": "intent"'):
+                    record = json.loads(line)
+                    if record["seq"] in commits:
+                        commits.discard(record["seq"])
+                        yield record["old"], record["new"]
+
+    # Records that a run was reverted
+    @staticmethod
+    def markReverted(journalFile, runId):
+        time = datetime.now().isoformat(timespec="seconds")
+        with open(journalFile, "a", encoding="utf-8") as file:
+            offset = file.tell()
+            file.write(json.dumps({"type": "revert", "time": time, "run": runId}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        Journal.addToIndex(journalFile, Journal.IndexEntry(offset, "revert", runId, time))
+
+    def write(self, record):
+        record["run"] = self.runId
+        self.file.write(json.dumps(record) + "\n")
+
+    # Returns the sequence number of the move
+    def intent(self, oldFilePath, newFilePath):
+        self.seq += 1
+        self.intents[self.seq] = (oldFilePath, newFilePath)
+        self.write({"type": "intent", "seq": self.seq, "old": oldFilePath, "new": newFilePath})
+        return self.seq
+
+    # moved only holds the files moved before resuming (organize() skips them), it does not grow with this run
+    def commit(self, seq, strategy):
+        self.intents.pop(seq)
+        self.write({"type": "commit", "seq": seq, "strategy": strategy})
+
+    def abort(self, seq):
+        self.intents.pop(seq, None)
+        self.write({"type": "abort", "seq": seq})
+
+    def markIngested(self):
+        self.ingested = True
+        self.write({"type": "ingested"})
+        self.sync()
+
+    def end(self):
+        self.write({"type": "end", "time": datetime.now().isoformat(timespec="seconds")})
+        self.sync()
+
+    def sync(self):
+        started = perf_counter()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        metrics.observe("journal.fsync", perf_counter() - started)
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+
+##################################################################
+# TRANSFER ENGINE
+##################################################################
+class TransferEngine():
+    '''
+    Moves files into the _Media Vault folder. Files on the same device are simply renamed, the others are copied
+    (with copy_file_range/sendfile when available, or a buffered copy otherwise), optionally verified, fsync'ed
+    and only then deleted from their source. Every move returns the strategy that was used
+    '''
+    class TransferFailedException(OSError):
+        ''' This exception will be raised if a copy does not match its source '''
+        pass
+
+    RENAME = "rename"
+    PARTIAL_SUFFIX = ".partial"
+
+    def __init__(self, max_concurrent_copies):
+        self.copySlots = threading.BoundedSemaphore(max(1, max_concurrent_copies))
+        self.statsLock = threading.Lock()
+        # stats --> strategy: [files, bytes, seconds]
+        self.stats = {}
+
+    def move(self, src, dst):
+        start = datetime.now()
+        srcStat = os.stat(src)
+        strategy = TransferEngine.RENAME
+        try:
+            if srcStat.st_dev != os.stat(os.path.dirname(dst)).st_dev:
+                raise OSError(errno.EXDEV, "Source and target are on different devices")
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            with self.copySlots:
+                strategy = self.transfer(src, dst)
+        self.record(strategy, srcStat.st_size, (datetime.now() - start).total_seconds())
+        metrics.observe(f"move.{strategy}", (datetime.now() - start).total_seconds())
+        return strategy
+
+    # Copies src into dst (through a temporary file, so dst never holds a partial copy) and deletes src
+    def transfer(self, src, dst):
+        partial = dst + TransferEngine.PARTIAL_SUFFIX
+        if os.path.exists(partial):
+            # Left behind by a run that was killed while copying
+            os.remove(partial)
+        try:
+            with open(src, 'rb') as source, open(partial, 'xb') as target:
+                strategy = self.copy(source, target)
+                target.flush()
+                os.fsync(target.fileno())
+            shutil.copystat(src, partial)
+            if VERIFY_TRANSFERS and self.hash(src) != self.hash(partial):
+                raise TransferEngine.TransferFailedException(f"Copy of {src} does not match its source")
+            os.rename(partial, dst)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        self.fsyncDirectory(os.path.dirname(dst))
+        os.remove(src)
+        return strategy
+
+    # Copies the content of source into target, returning the strategy that was used
+    def copy(self, source, target):
+        size = os.fstat(source.fileno()).st_size
+        for strategy, copyChunk in (("copy_file_range", getattr(os, 'copy_file_range', None)),
+                                    ("sendfile", self.sendfileChunk if hasattr(os, 'sendfile') else None)):
+            if copyChunk is None:
+                continue
+            try:
+                offset = 0
+                while offset < size:
+                    copied = copyChunk(source.fileno(), target.fileno(), size - offset, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                if offset == size:
+                    return strategy
+            except OSError:
+                pass
+            # Start over with the next strategy
+            target.seek(0)
+            target.truncate()
+        source.seek(0)
+        shutil.copyfileobj(source, target, TRANSFER_BUFFER_SIZE)
+        return "buffered"
+
+    @staticmethod
+    def sendfileChunk(source_fd, target_fd, count, source_offset, target_offset):
+        os.lseek(target_fd, target_offset, os.SEEK_SET)
+        return os.sendfile(target_fd, source_fd, source_offset, count)
+
+    @staticmethod
+    def hash(file_path):
+        digest = hashlib.blake2b()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(TRANSFER_BUFFER_SIZE), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    @staticmethod
+    def fsyncDirectory(directory):
+        try:
+            directory_fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(directory_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(directory_fd)
+
+    def record(self, strategy, size, seconds):
+        with self.statsLock:
+            stats = self.stats.setdefault(strategy, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += seconds
+
+    def report(self):
+        for strategy, (files, size, seconds) in sorted(self.stats.items()):
+            throughput = size / seconds / 1024 / 1024 if seconds else 0
+            logger.info(f"Transfers ({strategy}): {files} files, {size / 1024 / 1024:.1f} MB, {throughput:.1f} MB/s.")
+
+
+
+##################################################################
+# DEDUP INDEX
+##################################################################
+class DedupIndex():
+    '''
+    Persistent index of the content of the files stored in the _Media Vault folder.
+    Files are looked up by their size and a hash of their first and last DEDUP_SAMPLE_SIZE bytes (an indexed query),
+    and their full content is only hashed when that prefilter matches, so lookups do not grow with the archive size.
+    The index is built once from the vault and then kept up to date as files are moved into it. A stored file whose
+    size or modification time changed since it was indexed (e.g. edited outside of the script) is indexed again
+    before being compared, as its hashes no longer describe its content
+    '''
+    def __init__(self, indexFile, vaultFolder):
+        # pending --> files planned to be moved into the vault: new path --> path they are being moved from
+        self.pending = {}
+        self.connection = sqlite3.connect(indexFile)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(contents)")]
+        if columns and "mtime_ns" not in columns:
+            # Index of an earlier version, which did not record when the files were indexed: built again
+            self.connection.execute("DROP TABLE contents")
+            self.connection.execute("DROP TABLE IF EXISTS built")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS contents (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, quick_hash BLOB, full_hash BLOB)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS contents_quick_hash ON contents (size, quick_hash)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS built (folder TEXT)")
+        if self.connection.execute("SELECT folder FROM built").fetchone() is None:
+            self.build(vaultFolder)
+        self.connection.commit()
+
+
+    # Indexes every file already stored in the vault (only runs once)
+    def build(self, vaultFolder):
+        logger.info("Building the deduplication index of the _Media Vault folder.")
+        for root, dirs, files in os.walk(vaultFolder):
+            if root.rstrip("/") == vaultFolder.rstrip("/"):
+                # Folders of the script itself (i.e. _shards)
+                dirs[:] = [folder for folder in dirs if not folder.startswith("_")]
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                if root.rstrip("/") == vaultFolder.rstrip("/") and filename.startswith("_"):
+                    # Files of the script itself
+                    continue
+                fingerprint = DedupIndex.fingerprint(file_path)
+                if fingerprint:
+                    self.connection.execute("INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?, ?)", (file_path,) + fingerprint)
+        self.connection.execute("INSERT INTO built VALUES (?)", (vaultFolder,))
+
+
+    # Returns (size, mtime_ns, quick hash, full hash), the latter is only computed on demand (i.e. None)
+    @staticmethod
+    def fingerprint(file_path):
+        try:
+            fileStat = os.stat(file_path)
+            size = fileStat.st_size
+            digest = hashlib.blake2b(size.to_bytes(8, 'little'), digest_size=16)
+            with open(file_path, 'rb') as file:
+                digest.update(file.read(DEDUP_SAMPLE_SIZE))
+                if size > DEDUP_SAMPLE_SIZE:
+                    file.seek(max(DEDUP_SAMPLE_SIZE, size - DEDUP_SAMPLE_SIZE))
+                    digest.update(file.read(DEDUP_SAMPLE_SIZE))
+        except OSError:
+            return None
+        return (size, fileStat.st_mtime_ns, digest.digest(), None)
+
+
+    # Returns (the path of a stored file with the same content or None, the fingerprint of file_path)
+    def lookup(self, file_path):
+        fingerprint = DedupIndex.fingerprint(file_path)
+        if fingerprint is None:
+            return None, None
+        size, mtime, quickHash, fullHash = fingerprint
+        candidates = self.connection.execute(
+            "SELECT path, mtime_ns, full_hash FROM contents WHERE size = ? AND quick_hash = ?", (size, quickHash)).fetchall()
+        for candidatePath, candidateMtime, candidateHash in candidates:
+            if candidatePath == file_path:
+                # The file is already in the vault (e.g. TRAVERSE_SUBDIRS)
+                continue
+            try:
+                candidateStat = self.statStoredFile(candidatePath)
+                if candidateStat is None:
+                    # The file was removed from the vault since it was indexed
+                    self.forget(candidatePath)
+                    continue
+                if (candidateStat.st_size, candidateStat.st_mtime_ns) != (size, candidateMtime):
+                    # The file was changed since it was indexed, so it is not trusted to hold the same content
+                    self.reindex(candidatePath)
+                    continue
+                if candidateHash is None:
+                    candidateHash = self.hashStoredFile(candidatePath)
+                    if candidateHash is None:
+                        # The file was removed from the vault since it was indexed
+                        self.forget(candidatePath)
+                        continue
+                    self.connection.execute("UPDATE contents SET full_hash = ? WHERE path = ?", (candidateHash, candidatePath))
+                if fullHash is None:
+                    fullHash = TransferEngine.hash(file_path)
+                    fingerprint = (size, mtime, quickHash, fullHash)
+            except OSError as e:
+                logger.debug(f"Unable to compare {file_path} with {candidatePath} due to: {str(e)}.")
+                continue
+            if candidateHash == fullHash:
+                return candidatePath, fingerprint
+        return None, fingerprint
+
+
+    # Stats a file of the vault, which might still be on its way there (returns None if it no longer exists)
+    def statStoredFile(self, file_path):
+        for readablePath in (self.pending.get(file_path), file_path):
+            if readablePath:
+                try:
+                    return os.stat(readablePath)
+                except FileNotFoundError:
+                    pass
+        return None
+
+
+    # Indexes a file of the vault again (its hashes are computed from its current content)
+    def reindex(self, file_path):
+        fingerprint = DedupIndex.fingerprint(self.pending.get(file_path) or file_path)
+        if fingerprint is None:
+            self.forget(file_path)
+            return
+        self.connection.execute("INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?, ?)", (file_path,) + fingerprint)
+
+
+    # Hashes a file of the vault, which might still be on its way there (returns None if it no longer exists)
+    def hashStoredFile(self, file_path):
+        for readablePath in (self.pending.get(file_path), file_path):
+            if readablePath:
+                try:
+                    return TransferEngine.hash(readablePath)
+                except FileNotFoundError:
+                    pass
+        return None
+
+
+    # Records a file moved into the vault (pendingFrom is where it lives until the move completes)
+    def remember(self, file_path, fingerprint, pendingFrom=None):
+        if fingerprint is None:
+            return
+        if pendingFrom:
+            self.pending[file_path] = pendingFrom
+            self.connection.execute("DELETE FROM contents WHERE path = ?", (pendingFrom,))
+        self.connection.execute("INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?, ?)", (file_path,) + fingerprint)
+
+    def isPending(self, file_path):
+        return file_path in self.pending
+
+    # The file was moved into the vault
+    def settle(self, file_path):
+        self.pending.pop(file_path, None)
+
+    def forget(self, file_path):
+        self.pending.pop(file_path, None)
+        self.connection.execute("DELETE FROM contents WHERE path = ?", (file_path,))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+
+##################################################################
+# METADATA CACHE
+##################################################################
+class MetadataCache():
+    '''
+    Persists the IngestResult of every file, keyed by (path, size, mtime_ns, inode), so that a file is
+    only parsed again if it changed. Files are renamed in place by organize(), which keeps their key valid.
+    The least recently seen entries are evicted whenever the cache grows beyond max_entries
+    '''
+    # Version of the readers and processors: bump it whenever they extract other dates than before (e.g. a new format
+    # is supported), as files that could not be dated are cached too and would not be parsed again otherwise
+    VERSION = 3
+
+    # Settings that change the outcome of an ingest: the cache is dropped whenever they change
+    @staticmethod
+    def settings():
+        patterns = hashlib.blake2b("\n".join(LuckyMatcher.patterns).encode("utf-8"), digest_size=8).hexdigest()
+        return f"v{MetadataCache.VERSION} lucky={IM_FEELING_LUCKY} patterns={patterns}"
+
+    def __init__(self, cacheFile, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pendingWrites = 0
+        self.seenPaths = []
+        self.runTimestamp = int(datetime.now().timestamp())
+
+        self.connection = None
+        if not max_entries:
+            return
+        try:
+            self.connection = sqlite3.connect(cacheFile)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings (value TEXT)")
+            settings = self.connection.execute("SELECT value FROM settings").fetchone()
+            if settings is None or settings[0] != MetadataCache.settings():
+                self.connection.execute("DROP TABLE IF EXISTS files")
+                self.connection.execute("DELETE FROM settings")
+                self.connection.execute("INSERT INTO settings VALUES (?)", (MetadataCache.settings(),))
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER,
+                capture_date TEXT, capture_time TEXT, processor TEXT, file_format TEXT, last_seen INTEGER)""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_last_seen ON files (last_seen)")
+            self.connection.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Metadata cache is disabled. Unable to open {cacheFile} due to: {str(e)}.")
+            self.connection = None
+
+
+    # Returns the key of a file or None if it can not be stat'ed
+    @staticmethod
+    def file_key(file_path):
+        try:
+            # The stat result of a DirEntry (from the walker) is reused
+            fileStat = file_path.stat() if isinstance(file_path, os.DirEntry) else os.stat(file_path)
+        except OSError:
+            return None
+        return (os.path.abspath(file_path), fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino)
+
+
+    # Returns the cached IngestResult of a file or None (a changed file evicts its stale entry)
+    def get(self, fileKey):
+        if self.connection is None or fileKey is None:
+            return None
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, inode, capture_date, capture_time, processor, file_format FROM files WHERE path = ?",
+            (fileKey[0],)).fetchone()
+        if row is None or tuple(row[:3]) != fileKey[1:]:
+            self.misses += 1
+            if row is not None:
+                self.evictions += 1
+                self.connection.execute("DELETE FROM files WHERE path = ?", (fileKey[0],))
+                self.pendingWrite()
+            return None
+        self.hits += 1
+        self.seenPaths.append((self.runTimestamp, fileKey[0]))
+        if len(self.seenPaths) >= METADATA_CACHE_COMMIT_INTERVAL:
+            self.commit()
+        return IngestResult(fileKey[0], *row[3:])
+
+
+    def put(self, fileKey, result):
+        if self.connection is None or fileKey is None:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                fileKey + (result.date, result.time, result.processor, result.file_format, self.runTimestamp))
+        self.pendingWrite()
+
+
+    # Follows a file that was moved (a copy across file systems gets a new inode)
+    def relocate(self, old_path, new_path):
+        newKey = MetadataCache.file_key(new_path)
+        if self.connection is None or newKey is None:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO files SELECT ?, ?, ?, ?, capture_date, capture_time, processor, file_format, last_seen FROM files WHERE path = ?",
+                                newKey + (old_path,))
+        self.connection.execute("DELETE FROM files WHERE path = ?", (old_path,))
+        self.pendingWrite()
+
+
+    def pendingWrite(self):
+        self.pendingWrites += 1
+        if self.pendingWrites >= METADATA_CACHE_COMMIT_INTERVAL:
+            self.commit()
+
+
+    def commit(self):
+        if self.connection is None:
+            return
+        self.connection.executemany("UPDATE files SET last_seen = ? WHERE path = ?", self.seenPaths)
+        self.seenPaths = []
+        self.connection.commit()
+        self.pendingWrites = 0
+
+
+    # Evicts the least recently seen entries above max_entries and closes the cache
+    def close(self):
+        if self.connection is None:
+            return
+        self.commit()
+        excess = self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute("DELETE FROM files WHERE path IN (SELECT path FROM files ORDER BY last_seen LIMIT ?)", (excess,))
+            self.evictions += excess
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+        logger.info(f"Metadata cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions.")
+
+
+
+##################################################################
+# MANIFEST
+##################################################################
+class Manifest(ABC):
+    '''
+    The manifest is where ingest() records the files (and the number of files per relative date)
+    from which organize() will read afterwards. Rows are buffered and written in batches
+    '''
+    def __init__(self, manifestFile, resume=False):
+        self.manifestFile = manifestFile
+        self.buffer = []
+        self.setup(resume)
+
+    # Returns the manifest implementation selected by MANIFEST_BACKEND
+    @staticmethod
+    def create(resume=False):
+        if MANIFEST_BACKEND == "csv":
+            return CSVManifest(os.getcwd() + "/" + "mediaVaultData.csv", resume)
+        return SQLiteManifest(os.getcwd() + "/" + "mediaVaultData.sqlite", resume)
+
+    # Sets up the manifest on instantiation (an existing manifest is only picked up when resuming)
+    def setup(self, resume):
+        if os.path.exists(self.manifestFile) and not resume:
+            logger.error(f"A {os.path.basename(self.manifestFile)} already exists in the working directory. Will not override it (use --resume to continue the run that created it).")
+            sys.exit(1)  # Halt the program as it should not run with logging its changes
+        try:
+            self.open()
+        except Exception as e:
+            logger.error(f"Halting. Unable to create/write to {os.path.basename(self.manifestFile)} due to: {str(e)}.")
+            sys.exit(1) # Halt
+
+    def write(self, original_path, capture_date, capture_time, relative_date):
+        self.buffer.append((original_path, capture_date, capture_time, relative_date))
+        if len(self.buffer) >= MANIFEST_BATCH_SIZE:
+            self.flush()
+
+    @abstractmethod
+    def open(self):
+        pass
+
+    @abstractmethod
+    def flush(self):
+        """
+        Persist the buffered rows in a single batch.
+        """
+        pass
+
+    @abstractmethod
+    def paths(self):
+        """
+        Return the set of original paths on the manifest.
+        """
+        pass
+
+    @abstractmethod
+    def dateCounts(self):
+        """
+        Return the number of files per relative date.
+        """
+        pass
+
+    @abstractmethod
+    def read(self):
+        """
+        Yield (original_path, capture_date, capture_time, relative_date) sorted by relative date,
+        keeping the ingest order within each date.
+        """
+        pass
+
+    @abstractmethod
+    def delete(self):
+        pass
+
+
+
+##################################################################
+# MANIFEST >> SQLITE MANIFEST
+##################################################################
+class SQLiteManifest(Manifest):
+    def open(self):
+        self.connection = sqlite3.connect(self.manifestFile)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+            seq INTEGER PRIMARY KEY, original_path TEXT, capture_date TEXT, capture_time TEXT, relative_date TEXT)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_relative_date ON files (relative_date, seq)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS date_counts (relative_date TEXT PRIMARY KEY, count INTEGER)")
+        self.connection.commit()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        started = perf_counter()
+        counts = {}
+        for row in self.buffer:
+            counts[row[3]] = counts.get(row[3], 0) + 1
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO files (original_path, capture_date, capture_time, relative_date) VALUES (?, ?, ?, ?)", self.buffer)
+            self.connection.executemany(
+                "INSERT INTO date_counts VALUES (?, ?) ON CONFLICT (relative_date) DO UPDATE SET count = count + excluded.count",
+                counts.items())
+        metrics.count("manifest.rows", len(self.buffer))
+        metrics.observe("manifest.flush", perf_counter() - started)
+        self.buffer = []
+
+    def paths(self):
+        self.flush()
+        paths = memoryBudget.pathSet()
+        paths.update(row[0] for row in self.connection.execute("SELECT original_path FROM files"))
+        return paths
+
+    def dateCounts(self):
+        self.flush()
+        return dict(self.connection.execute("SELECT relative_date, count FROM date_counts"))
+
+    def read(self):
+        self.flush()
+        yield from self.connection.execute(
+            "SELECT original_path, capture_date, capture_time, relative_date FROM files ORDER BY relative_date, seq")
+
+    def delete(self):
+        self.connection.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.manifestFile + suffix):
+                os.remove(self.manifestFile + suffix)
+
+
+
+##################################################################
+# MANIFEST >> CSV MANIFEST
+##################################################################
+class CSVManifest(Manifest):
+    '''
+    Plain csv manifest (handy to inspect). The number of files per date is kept in memory
+    '''
+    RECORD_OVERHEAD = 41 # Bytes taken by a packed record on a sort run, besides its content (bytes object and list slot)
+    RECORD_HEADER = struct.Struct('>IQq') # Rank of the relative date, ingest order, packed capture date and time (0 if not packed)
+
+    def open(self):
+        self.counts = {}
+        self.datePlanner = DatePlanner()
+        if os.path.exists(self.manifestFile):
+            # Resuming: recount the rows written so far
+            with open(self.manifestFile, 'r', newline='') as file:
+                for row in csv.reader(file):
+                    self.counts[row[3]] = self.counts.get(row[3], 0) + 1
+        self.file = open(self.manifestFile, "a", newline='')
+        self.writer = csv.writer(self.file)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        started = perf_counter()
+        self.writer.writerows(self.buffer)
+        self.file.flush()
+        for row in self.buffer:
+            self.counts[row[3]] = self.counts.get(row[3], 0) + 1
+        metrics.count("manifest.rows", len(self.buffer))
+        metrics.observe("manifest.flush", perf_counter() - started)
+        self.buffer = []
+
+    def paths(self):
+        self.flush()
+        paths = memoryBudget.pathSet()
+        with open(self.manifestFile, 'r', newline='') as file:
+            paths.update(row[0] for row in csv.reader(file))
+        return paths
+
+    def dateCounts(self):
+        self.flush()
+        return dict(self.counts)
+
+    # Rows are packed into bytes that sort by relative date and then by ingest order, with the dates packed as integers.
+    # In low memory mode they are sorted in runs that fit the memory budget (and shrink while the memory usage is over
+    # MEMORY_LIMIT), spilled to temporary files and merged
+    def read(self):
+        self.flush()
+        relativeDates = sorted(self.counts)
+        ranks = {relativeDate: rank for rank, relativeDate in enumerate(relativeDates)}
+        runSize = memoryBudget.share("sort")
+        runs = []
+        run, runBytes = [], 0
+        with open(self.manifestFile, 'r', newline='') as file:
+            for seq, (original_path, capture_date, capture_time, relative_date) in enumerate(csv.reader(file)):
+                record = self.pack(ranks[relative_date], seq, original_path, capture_date, capture_time)
+                run.append(record)
+                runBytes += len(record) + CSVManifest.RECORD_OVERHEAD
+                if runSize and seq % MemoryBudget.CHECK_INTERVAL == 0:
+                    runSize = memoryBudget.degrade("sort", runSize)
+                if runSize and runBytes >= runSize:
+                    run.sort()
+                    runs.append(self.spill(run))
+                    run, runBytes = [], 0
+        run.sort()
+        records = heapq.merge(*(CSVManifest.unspill(spilled) for spilled in runs), run) if runs else run
+        for record in records:
+            yield self.unpack(record, relativeDates)
+
+    # header (RECORD_HEADER) original_path, followed by \0 capture_date \0 capture_time if the dates could not be packed
+    def pack(self, rank, seq, original_path, capture_date, capture_time):
+        packed = self.datePlanner.pack(capture_date, capture_time)
+        record = CSVManifest.RECORD_HEADER.pack(rank, seq, packed or 0) + original_path.encode("utf-8", "surrogateescape")
+        if packed is None:
+            record += b'\0' + capture_date.encode("utf-8", "surrogateescape") + b'\0' + capture_time.encode("utf-8", "surrogateescape")
+        return record
+
+    def unpack(self, record, relativeDates):
+        rank, seq, packed = CSVManifest.RECORD_HEADER.unpack_from(record)
+        decode = lambda value: value.decode("utf-8", "surrogateescape")
+        rest = record[CSVManifest.RECORD_HEADER.size:]
+        if packed:
+            capture_date, capture_time = self.datePlanner.unpack(packed)
+            return decode(rest), capture_date, capture_time, relativeDates[rank]
+        original_path, capture_date, capture_time = rest.split(b'\0')
+        return decode(original_path), decode(capture_date), decode(capture_time) or None, relativeDates[rank]
+
+    # Writes a sorted run on a temporary file (next to the manifest) of length prefixed records
+    def spill(self, run):
+        import tempfile # Only needed here
+        spilled = tempfile.TemporaryFile(prefix="mediaVaultSort", dir=os.path.dirname(self.manifestFile))
+        for record in run:
+            spilled.write(struct.pack('>I', len(record)) + record)
+        spilled.seek(0)
+        return spilled
+
+    @staticmethod
+    def unspill(spilled):
+        with spilled:
+            while True:
+                header = spilled.read(4)
+                if not header:
+                    return
+                yield spilled.read(struct.unpack('>I', header)[0])
+
+    def delete(self):
+        self.file.close()
+        if os.path.exists(self.manifestFile):
+            os.remove(self.manifestFile)
+
+
+
+##################################################################
+# MANIFEST >> SHARD MANIFEST
+##################################################################
+class ShardManifest(SQLiteManifest):
+    '''
+    Manifest of a shard. Paths are stored relative to the folder where the script runs, as the hosts sharing it
+    may mount it on different paths
+    '''
+    def write(self, original_path, capture_date, capture_time, relative_date):
+        super().write(os.path.relpath(original_path), capture_date, capture_time, relative_date)
+
+    def paths(self):
+        self.flush()
+        paths = memoryBudget.pathSet()
+        paths.update(os.path.abspath(row[0]) for row in self.connection.execute("SELECT original_path FROM files"))
+        return paths
+
+    def read(self):
+        for original_path, capture_date, capture_time, relative_date in super().read():
+            yield os.path.abspath(original_path), capture_date, capture_time, relative_date
+
+
+
+##################################################################
+# MANIFEST >> MERGED MANIFEST
+##################################################################
+class MergedManifest(Manifest):
+    '''
+    Read only view of the manifests of every shard, for the merge: the files per date are added up and the rows are
+    merged in the order a single run would have ingested them (by relative date, then in the order of the walk),
+    so the folders and the names given to the files do not depend on the number of shards
+    '''
+    def __init__(self, shardManifests):
+        self.shardManifests = shardManifests
+        self.manifestFile = None
+        self.buffer = []
+
+    def open(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def paths(self):
+        paths = memoryBudget.pathSet()
+        for shardManifest in self.shardManifests:
+            paths.update(shardManifest.paths())
+        return paths
+
+    def dateCounts(self):
+        counts = {}
+        for shardManifest in self.shardManifests:
+            for relative_date, count in shardManifest.dateCounts().items():
+                counts[relative_date] = counts.get(relative_date, 0) + count
+        return counts
+
+    def read(self):
+        yield from heapq.merge(*(shardManifest.read() for shardManifest in self.shardManifests),
+                               key=lambda row: (row[3], Walker.walkKey(row[0])))
+
+    def delete(self):
+        for shardManifest in self.shardManifests:
+            shardManifest.delete()
+
+
+
+##################################################################
+# MEDIA PROCESSOR
+##################################################################
+class MediaProcessor(ABC):
+    class FileTypeNotSupportedException(Exception):
+        ''' This exception will be raised if the file extension is not supported '''
+        pass
+
+    class CouldNotExtractCaptureDateException(Exception):
+        ''' This exception will be raised if the capture date could not be extracted '''
+        pass
+
+    def __init__(self, file_format=None):
+        # file_format --> set when FileTriage already established the file type (which spares the is_supported check)
+        self.file_format = file_format
+
+    @abstractmethod
+    def process(self, file_path):
+        """
+        Process a given file.
+        """
+        pass
+
+    @abstractmethod
+    def is_supported(self, file_path):
+        """
+        Check if the file is of supported media type.
+        """
+        pass
+
+    @abstractmethod
+    def get_capture_date(self, file_path):
+        """
+        Extract capture date from the media file.
+        """
+        pass
+        
+    def is_valid_datetime(self, date, time=None):
+        if date is None:
+            return False
+        try:
+            # Parse date and time
+            datetime_str    = f"{date} {time}" if time else date
+            datetime_format = f"{DATE_FORMAT} {TIME_FORMAT}" if time else DATE_FORMAT
+            datetime_obj    = datetime.strptime(datetime_str, datetime_format)
+            # Ensure the date is within a reasonable range
+            if datetime_obj.year < 1990 or datetime_obj > datetime.now():
+                return False
+            return True
+        except ValueError:
+            return False
+
+    def im_feeling_lucky(self, file_path):
+        ''' if the capture date fails to be retrieved from the file's metadata,
+            this method will try to retrieve it from the filename '''
+        capture_date = LuckyMatcher.match(os.path.basename(file_path))
+        metrics.count("lucky.attempts")
+        if capture_date:
+            metrics.count("lucky.hits")
+            return capture_date
+        # Exit gracefully
+        raise MediaProcessor.CouldNotExtractCaptureDateException("Could not extract a capture date")
+
+
+
+##################################################################
+# LUCKY MATCHER
+##################################################################
+class LuckyMatcher():
+    '''
+    Retrieves capture dates from filenames. Patterns are compiled once and tried in order (the first valid match wins),
+    but a single search of their combined alternation rejects the filenames none of them match, and patterns whose
+    leading literal (e.g. "IMG_") is not on the filename are skipped. Dates are validated arithmetically
+    '''
+    SEARCH_PATTERNS_LIST = [
+        # Whatsapp
+        r'IMG_(\d{4})(\d{2})(\d{2})',
+        r'WhatsApp Image (\d{4})-(\d{2})-(\d{2}) at (\d{2})\.(\d{2})\.(\d{2})',
+        r'WhatsApp Video (\d{4})-(\d{2})-(\d{2}) at (\d{2})\.(\d{2})\.(\d{2})',
+        r'IMG_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})', 
+        r'IMG-(\d{4})(\d{2})(\d{2})',
+        r'VID-(\d{4})(\d{2})(\d{2})',
+        # Samsung phone 2022
+        r'Screenshot_(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})',
+        r'(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})',
+        # This script (and older versions) so it is idempotent
+        r'(\d{4})\.(\d{2})\.(\d{2}) \((\d{2})h(\d{2})m(\d{2})s\)',
+        r'(\d{4})\.(\d{2})\.(\d{2}) (?: \(\d+\))?',
+        # Other
+        r'WIN-(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})',
+        r'WIN-(\d{4})(\d{2})(\d{2})_(\d{2})_(\d{2})_(\d{2})_Pro'
+    ]
+    DAYS_PER_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+    # compiledPatterns --> [(leading literal, compiled pattern)], prefilter --> alternation of every pattern
+    # Patterns are compiled when the first filename is matched, so that importing the script stays cheap
+    patterns = []
+    compiledPatterns = []
+    prefilter = None
+
+    # Patterns from the configuration (LUCKY_EXTRA_PATTERNS) are validated as they are registered, exits if one is not valid
+    @classmethod
+    def register(cls, pattern, validate=False):
+        if validate:
+            try:
+                cls.validate(pattern)
+            except re.error as e:
+                logger.error(f"Halting. The lucky pattern {pattern} is not valid: {str(e)}.")
+                sys.exit(1)
+        cls.patterns.append(pattern)
+        cls.prefilter = None
+
+    @classmethod
+    def validate(cls, pattern):
+        compiled = re.compile(pattern)
+        # Inline global flags (e.g. "(?i)") cannot be combined into the prefilter, scoped ones (e.g. "(?i:...)") can
+        if compiled.flags & ~re.UNICODE:
+            raise re.error("global flags are not supported, scope them to a group instead (e.g. (?i:...))")
+        if compiled.groups not in (3, 6):
+            raise re.error("it must capture (year, month, day) or (year, month, day, hour, minute, second)")
+        re.compile(cls.uncaptured(pattern))
+
+    @classmethod
+    def compile(cls):
+        cls.compiledPatterns = [(cls.leadingLiteral(pattern), re.compile(pattern)) for pattern in cls.patterns]
+        cls.prefilter = re.compile("|".join(cls.uncaptured(pattern) for pattern in cls.patterns))
+
+    # The combined alternation does not need to capture anything (and group names would clash across patterns)
+    @staticmethod
+    def uncaptured(pattern):
+        return re.sub(r'(?<!\\)\((?:\?P<\w+>)?(?!\?)', '(?:', pattern)
+
+    # The literal every match of the pattern starts with (e.g. "IMG_"), or "" if there is none
+    @staticmethod
+    def leadingLiteral(pattern):
+        if "|" in pattern:
+            return ""
+        literal = re.match(r'[^\\.^$*+?{}\[\]|()]*', pattern).group()
+        # The last character is optional if a quantifier follows it (e.g. "PXL_?" only guarantees "PXL")
+        if pattern[len(literal):len(literal) + 1] in ("?", "*", "{"):
+            literal = literal[:-1]
+        return literal
+
+    # Returns (date, time) or None. time is None if the filename only holds a date
+    @classmethod
+    def match(cls, filename, now=None):
+        if cls.prefilter is None:
+            cls.compile()
+        if not cls.prefilter.search(filename):
+            return None
+        now = now or datetime.now().timetuple()[:6]
+        for literal, pattern in cls.compiledPatterns:
+            if literal not in filename:
+                continue
+            match = pattern.search(filename)
+            if match:
+                groups = match.groups()
+                if cls.is_valid(groups, now):
+                    date = f"{groups[0]}.{groups[1]}.{groups[2]}"
+                    time = f"{groups[3]}.{groups[4]}.{groups[5]}" if len(groups) == 6 else None
+                    return (date, time)
+        return None
+
+    @classmethod
+    def match_many(cls, filenames):
+        now = datetime.now().timetuple()[:6]
+        return [cls.match(filename, now) for filename in filenames]
+
+    # Whether the captured (year, month, day[, hour, minute, second]) is a date between 1990 and now
+    @classmethod
+    def is_valid(cls, groups, now):
+        values = tuple(int(group) for group in groups) + (0, 0, 0)
+        year, month, day, hour, minute, second = values[:6]
+        if year < 1990 or not 1 <= month <= 12 or not 1 <= day <= cls.DAYS_PER_MONTH[month]:
+            return False
+        if month == 2 and day == 29 and (year % 4 or (year % 100 == 0 and year % 400)):
+            return False
+        if hour > 23 or minute > 59 or second > 59:
+            return False
+        return values[:6] <= now
+
+for pattern in LuckyMatcher.SEARCH_PATTERNS_LIST:
+    LuckyMatcher.register(pattern)
+for pattern in LUCKY_EXTRA_PATTERNS:
+    LuckyMatcher.register(pattern, validate=True)
+
+
+
+##################################################################
+# MEDIA PROCESSOR FACTORY
+##################################################################
+class MediaProcessorFactory:
+    @staticmethod
+    def create_processor(file_path, triage=None):
+        triage = triage or FileTriage.classify(file_path)
+        if triage.kind == FileTriage.IMAGE and (triage.sniffed or ImageProcessor().is_supported(file_path)):
+            return ImageProcessor(triage.file_format)
+        elif triage.kind == FileTriage.VIDEO:
+            return VideoProcessor(triage.file_format)
+        else:
+            raise MediaProcessor.FileTypeNotSupportedException("File type is not supported")
+
+
+
+##################################################################
+# FILE TRIAGE
+##################################################################
+class FileTriage():
+    '''
+    Classifies a file from its extension and the magic number on its first bytes (a single small read),
+    so that the factory can pick a processor straight away and reject non media files without invoking PIL or hachoir
+    '''
+    IMAGE = "image"
+    VIDEO = "video"
+    UNSUPPORTED = "unsupported"
+
+    # kind --> IMAGE/VIDEO/None, file_format --> e.g. "jpeg", "mp4", sniffed --> whether the magic number confirmed it
+    Triage = namedtuple('Triage', ['kind', 'file_format', 'sniffed'])
+
+    SNIFF_SIZE = 32
+
+    IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.jpe', '.tif', '.tiff', '.gif', '.bmp', '.png', '.webp', '.raw',
+                        '.cr2', '.nef', '.orf', '.arw', '.rw2', '.dng', '.heic', '.heif']
+    VIDEO_EXTENSIONS = ['.mp4', '.mov', '.mkv', '.avi', '.flv', '.webm', '.m4v']
+    # Rejected without even being read
+    NON_MEDIA_EXTENSIONS = ['.md', '.txt', '.csv', '.json', '.xml', '.xmp', '.aae', '.thm', '.ini', '.db', '.log',
+                            '.sqlite', '.sqlite-wal', '.sqlite-shm', '.py', '.pdf', '.zip']
+    NON_MEDIA_FILENAMES = ['.DS_Store', 'Thumbs.db', 'desktop.ini']
+
+    HEIF_BRANDS = (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'hevm', b'hevs', b'mif1', b'msf1')
+    # ISO-BMFF brands of video files. Other brands (e.g. 3GP) are only trusted by their extension
+    VIDEO_BRANDS = (b'isom', b'iso2', b'iso3', b'iso4', b'iso5', b'iso6', b'mp41', b'mp42', b'mp71', b'avc1', b'qt  ',
+                    b'M4V ', b'M4VH', b'M4VP', b'MSNV', b'XAVC', b'NDAS', b'CAEP', b'dash', b'mmp4', b'f4v ')
+    # ISO-BMFF brands of files that are not supported, whatever their extension: AVIF images and audio
+    REJECTED_BRANDS = (b'avif', b'avis', b'M4A ', b'M4B ', b'M4P ', b'F4A ', b'F4B ')
+    QUICKTIME_ATOMS = (b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot')
+
+    @staticmethod
+    def classify(file_path):
+        filename = os.path.basename(file_path)
+        file_extension = os.path.splitext(filename)[1].lower()
+        if file_extension in FileTriage.NON_MEDIA_EXTENSIONS or filename in FileTriage.NON_MEDIA_FILENAMES:
+            return FileTriage.Triage(None, FileTriage.UNSUPPORTED, False)
+
+        try:
+            with open(file_path, 'rb') as file:
+                header = file.read(FileTriage.SNIFF_SIZE)
+        except OSError:
+            return FileTriage.Triage(None, FileTriage.UNSUPPORTED, False)
+
+        file_format = FileTriage.sniff(header)
+        if file_format == FileTriage.UNSUPPORTED:
+            return FileTriage.Triage(None, FileTriage.UNSUPPORTED, True)
+        if file_format == 'quicktime':
+            # A bare QuickTime atom is a weak signature: only trusted on a video file
+            file_format = 'mp4' if file_extension in FileTriage.VIDEO_EXTENSIONS else None
+        if file_format in ('jpeg', 'tiff', 'orf', 'rw2', 'png', 'gif', 'bmp', 'webp', 'heif'):
+            return FileTriage.Triage(FileTriage.IMAGE, file_format, True)
+        if file_format in ('mp4', 'matroska', 'avi', 'flv'):
+            return FileTriage.Triage(FileTriage.VIDEO, file_format, True)
+
+        # The magic number is unknown, trust the extension
+        if file_extension in FileTriage.IMAGE_EXTENSIONS:
+            return FileTriage.Triage(FileTriage.IMAGE, file_extension[1:], False)
+        if file_extension in FileTriage.VIDEO_EXTENSIONS:
+            return FileTriage.Triage(FileTriage.VIDEO, file_extension[1:], False)
+        return FileTriage.Triage(None, FileTriage.UNSUPPORTED, False)
+
+    # Returns the file format matching the magic number on header (or None), UNSUPPORTED if it is known not to be media
+    @staticmethod
+    def sniff(header):
+        if header[:3] == ExifReader.JPEG_SIGNATURE:
+            return 'jpeg'
+        if header[:4] in (b'II*\x00', b'MM\x00*'):
+            return 'tiff'
+        if header[:4] in (b'IIRO', b'IIRS', b'MMOR'):
+            return 'orf'
+        if header[:4] == b'IIU\x00':
+            return 'rw2'
+        if header[:8] == b'\x89PNG\r\n\x1a\n':
+            return 'png'
+        if header[:6] in (b'GIF87a', b'GIF89a'):
+            return 'gif'
+        if header[:2] == b'BM' and header[6:10] == b'\x00\x00\x00\x00':
+            return 'bmp'
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return 'webp'
+        if header[:4] == b'RIFF' and header[8:12] == b'AVI ':
+            return 'avi'
+        if header[4:8] == b'ftyp':
+            brand = header[8:12]
+            if brand in FileTriage.HEIF_BRANDS:
+                return 'heif'
+            if brand in FileTriage.VIDEO_BRANDS:
+                return 'mp4'
+            if brand in FileTriage.REJECTED_BRANDS:
+                return FileTriage.UNSUPPORTED
+            return None
+        if header[4:8] in FileTriage.QUICKTIME_ATOMS:
+            return 'quicktime'
+        if header[:4] == b'\x1a\x45\xdf\xa3':
+            return 'matroska'
+        if header[:3] == b'FLV':
+            return 'flv'
+        return None
+
+
+
+##################################################################
+# MEDIA PROCESSOR >> IMAGE PROCESSOR
+##################################################################
+class ImageProcessor(MediaProcessor):
+    def process(self, file_path):
+        if self.file_format is None and not self.is_supported(file_path):
+            raise MediaProcessor.FileTypeNotSupportedException("File type is not supported")
+        return self.get_capture_date(file_path)
+
+    def is_supported(self, file_path):
+        '''
+        Check if file is supported (i.e. an image)
+        '''
+        if ExifReader.is_supported(file_path) or HeifReader.is_supported(file_path):
+            return True
+        try:
+            PILImage.open(file_path).close()
+            return True
+        except (IOError, SyntaxError):
+            return False
+
+    def get_capture_date(self, file_path):
+        try:
+            # Fast path: read DateTimeOriginal straight from the file's header
+            try:
+                capture_date = self.get_exif_datetime_original(file_path)
+            except MetadataReader.CouldNotParseException:
+                capture_date = self.get_pil_datetime_original(file_path)
+            if capture_date:
+                capture_date = datetime.strptime(capture_date, "%Y:%m:%d %H:%M:%S")
+                date = capture_date.strftime(DATE_FORMAT)
+                time = capture_date.strftime(TIME_FORMAT)
+                if self.is_valid_datetime(date, time):
+                    return (date, time)
+        except Exception as e:
+            # Handle all exceptions gracefully
+            pass
+
+        # Delegate to im_feeling_lucky or just assume a capture date was not found
+        if (IM_FEELING_LUCKY):
+            return self.im_feeling_lucky(file_path)
+        else:
+            raise MediaProcessor.CouldNotExtractCaptureDateException("Could not extract a capture date")
+
+    def get_exif_datetime_original(self, file_path):
+        if self.file_format in ('heif', 'heic') or (self.file_format is None and HeifReader.is_supported(file_path)):
+            capture_date = HeifReader.get_datetime_original(file_path)
+            metrics.count("image.heif_reader")
+        else:
+            capture_date = ExifReader.get_datetime_original(file_path)
+            metrics.count("image.exif_reader")
+        return capture_date
+
+    # Slow path: let PIL open the image and look for DateTimeOriginal on its exif data
+    def get_pil_datetime_original(self, file_path):
+        started = perf_counter()
+        try:
+            with PILImage.open(file_path) as image:
+                value = (image._getexif() or {}).get(ExifReader.TAG_DATETIME_ORIGINAL)
+                return str(value) if value else None
+        finally:
+            metrics.observe("image.pil", perf_counter() - started)
+
+
+
+##################################################################
+# METADATA READER
+##################################################################
+class MetadataReader():
+    '''
+    Metadata readers only parse the few structures of a container that hold its capture date.
+    Whenever they do not understand a file, they give up and let a full parser (PIL/hachoir) take over
+    '''
+    class CouldNotParseException(Exception):
+        ''' This exception will be raised if the file layout is not understood (callers should fall back to a full parser) '''
+        pass
+
+
+
+##################################################################
+# METADATA READER >> EXIF READER
+##################################################################
+class ExifReader(MetadataReader):
+    '''
+    Minimal reader for JPEG and TIFF based files (which includes CR2, NEF, ARW, DNG, ORF and RW2).
+    It seeks straight to the TIFF structure and only reads the few bytes needed to
+    retrieve DateTimeOriginal, instead of having PIL open the image and walk every tag
+    '''
+
+    TAG_EXIF_IFD          = 0x8769
+    TAG_DATETIME_ORIGINAL = 0x9003
+    TYPE_ASCII            = 2
+
+    JPEG_SIGNATURE  = b'\xff\xd8\xff'
+    TIFF_SIGNATURES = (
+        b'II*\x00', b'MM\x00*',           # TIFF, CR2, NEF, ARW, DNG
+        b'IIRO', b'IIRS', b'MMOR',        # ORF
+        b'IIU\x00'                        # RW2
+    )
+    EXIF_HEADER = b'Exif\x00\x00'
+
+    MAX_JPEG_SEGMENTS = 32   # APP1 is expected right at the beginning of the file
+    MAX_IFD_ENTRIES   = 1024 # Anything above this is a corrupted file
+
+    @staticmethod
+    def is_supported(file_path):
+        try:
+            with open(file_path, 'rb') as file:
+                header = file.read(4)
+        except OSError:
+            return False
+        return header[:3] == ExifReader.JPEG_SIGNATURE or header in ExifReader.TIFF_SIGNATURES
+
+    @staticmethod
+    def get_datetime_original(file_path):
+        '''
+        Returns the raw DateTimeOriginal value (e.g. "2023:01:05 10:00:00") or None if the file has none.
+        Raises CouldNotParseException if the file is not laid out as expected
+        '''
+        try:
+            with open(file_path, 'rb') as file:
+                header = file.read(4)
+                if header[:3] == ExifReader.JPEG_SIGNATURE:
+                    tiff_offset = ExifReader.find_jpeg_tiff_offset(file)
+                    if tiff_offset is None:
+                        return None
+                elif header in ExifReader.TIFF_SIGNATURES:
+                    tiff_offset = 0
+                else:
+                    raise ExifReader.CouldNotParseException("Not a JPEG/TIFF file")
+                return ExifReader.read_datetime_original(file, tiff_offset)
+        except (OSError, struct.error, UnicodeDecodeError) as e:
+            raise ExifReader.CouldNotParseException(str(e))
+
+    # Walks the JPEG markers up to the APP1 (Exif) segment and returns the offset of its TIFF header
+    @staticmethod
+    def find_jpeg_tiff_offset(file):
+        file.seek(2)
+        for _ in range(ExifReader.MAX_JPEG_SEGMENTS):
+            marker = file.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                raise ExifReader.CouldNotParseException("Invalid JPEG marker")
+            if marker[1] in (0xD9, 0xDA):
+                # End of image / start of the compressed data: there is no exif
+                return None
+            segment_length = struct.unpack('>H', file.read(2))[0]
+            segment_start = file.tell()
+            if marker[1] == 0xE1 and file.read(6) == ExifReader.EXIF_HEADER:
+                return segment_start + 6
+            file.seek(segment_start + segment_length - 2)
+        raise ExifReader.CouldNotParseException("Exif segment not found")
+
+    @staticmethod
+    def read_datetime_original(file, tiff_offset):
+        file.seek(tiff_offset)
+        header = file.read(8)
+        if header[:2] == b'II':
+            byte_order = '<'
+        elif header[:2] == b'MM':
+            byte_order = '>'
+        else:
+            raise ExifReader.CouldNotParseException("Invalid TIFF header")
+        ifd0_offset = struct.unpack(byte_order + 'I', header[4:8])[0]
+
+        # DateTimeOriginal belongs to the Exif IFD (pointed to by IFD0), though some writers put it on IFD0
+        ifd0 = ExifReader.read_ifd(file, tiff_offset, byte_order, ifd0_offset)
+        entry = ifd0.get(ExifReader.TAG_DATETIME_ORIGINAL)
+        if entry is None and ExifReader.TAG_EXIF_IFD in ifd0:
+            exif_ifd_offset = struct.unpack(byte_order + 'I', ifd0[ExifReader.TAG_EXIF_IFD][2])[0]
+            entry = ExifReader.read_ifd(file, tiff_offset, byte_order, exif_ifd_offset).get(ExifReader.TAG_DATETIME_ORIGINAL)
+        if entry is None:
+            return None
+
+        value_type, count, value = entry
+        if value_type != ExifReader.TYPE_ASCII:
+            return None
+        if count > 4:
+            file.seek(tiff_offset + struct.unpack(byte_order + 'I', value)[0])
+            value = file.read(count)
+        return value[:count].split(b'\x00')[0].decode('ascii').strip() or None
+
+    # Returns the entries of an IFD as {tag: (type, count, raw 4 byte value/offset)}
+    @staticmethod
+    def read_ifd(file, tiff_offset, byte_order, ifd_offset):
+        file.seek(tiff_offset + ifd_offset)
+        nr_entries = struct.unpack(byte_order + 'H', file.read(2))[0]
+        if nr_entries > ExifReader.MAX_IFD_ENTRIES:
+            raise ExifReader.CouldNotParseException("Corrupted IFD")
+        data = file.read(nr_entries * 12)
+        entries = {}
+        for i in range(0, len(data) - 11, 12):
+            tag, value_type, count = struct.unpack(byte_order + 'HHI', data[i:i+8])
+            entries[tag] = (value_type, count, data[i+8:i+12])
+        return entries
+
+
+
+##################################################################
+# METADATA READER >> HEIF READER
+##################################################################
+class HeifReader(MetadataReader):
+    '''
+    Reader for HEIF files (HEIC photos from iPhones), which PIL cannot open without extra plugins.
+    The Exif block is an item of its own: meta/iinf gives its ID and meta/iloc the extents holding its bytes,
+    which are the only ones read (no image is decoded) before ExifReader looks for DateTimeOriginal on them
+    '''
+    EXIF_ITEM_TYPE = b'Exif'
+    MAX_EXIF_SIZE  = 1024 * 1024 # Exif items take a few KB, anything above this is a corrupted file
+    MAX_ITEMS      = 65536
+
+    @staticmethod
+    def is_supported(file_path):
+        try:
+            with open(file_path, 'rb') as file:
+                header = file.read(12)
+        except OSError:
+            return False
+        return header[4:8] == b'ftyp' and header[8:12] in FileTriage.HEIF_BRANDS
+
+    @staticmethod
+    def get_datetime_original(file_path):
+        '''
+        Returns the raw DateTimeOriginal value (e.g. "2023:01:05 10:00:00") or None if the file has none.
+        Raises CouldNotParseException if the file is not laid out as expected
+        '''
+        try:
+            with open(file_path, 'rb') as file:
+                file_size = os.fstat(file.fileno()).st_size
+                meta = IsoBmffReader.find_box(file, 0, file_size, b'meta')
+                if meta is None:
+                    raise MetadataReader.CouldNotParseException("meta not found")
+                # meta is a full box: its children come after the version and flags
+                meta_start, meta_end = meta[0] + 4, meta[1]
+                iinf = IsoBmffReader.find_box(file, meta_start, meta_end, b'iinf')
+                iloc = IsoBmffReader.find_box(file, meta_start, meta_end, b'iloc')
+                if iinf is None or iloc is None:
+                    raise MetadataReader.CouldNotParseException("meta/iinf or meta/iloc not found")
+
+                item_id = HeifReader.find_exif_item(file, *iinf)
+                if item_id is None:
+                    return None
+                location = HeifReader.find_item_location(file, *iloc, item_id)
+                if location is None:
+                    raise MetadataReader.CouldNotParseException("The Exif item has no location")
+                exif = HeifReader.read_item(file, meta_start, meta_end, *location)
+        except (OSError, struct.error, IndexError) as e:
+            raise MetadataReader.CouldNotParseException(str(e))
+
+        # The Exif item starts with the offset of the TIFF header (usually past an "Exif\0\0" header)
+        tiff_offset = 4 + struct.unpack('>I', exif[:4])[0]
+        try:
+            return ExifReader.read_datetime_original(io.BytesIO(exif), tiff_offset)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise MetadataReader.CouldNotParseException(str(e))
+
+    # Returns the ID of the Exif item listed on iinf (or None)
+    @staticmethod
+    def find_exif_item(file, start, end):
+        file.seek(start)
+        version = file.read(4)[0]
+        entries_start = start + 4 + (2 if version == 0 else 4)
+        for box_type, payload_start, box_end in IsoBmffReader.iter_boxes(file, entries_start, end):
+            if box_type != b'infe':
+                continue
+            file.seek(payload_start)
+            version = file.read(4)[0]
+            if version < 2:
+                # Only infe version 2+ carries the item type
+                continue
+            id_size = 2 if version == 2 else 4
+            item_id = HeifReader.read_uint(file, id_size)
+            file.seek(2, os.SEEK_CUR) # item_protection_index
+            if file.read(4) == HeifReader.EXIF_ITEM_TYPE:
+                return item_id
+        return None
+
+    # Returns the (construction_method, base_offset, [(extent_offset, extent_length)]) of an item listed on iloc (or None)
+    @staticmethod
+    def find_item_location(file, start, end, item_id):
+        file.seek(start)
+        version = file.read(4)[0]
+        sizes = file.read(2)
+        offset_size, length_size = sizes[0] >> 4, sizes[0] & 0x0F
+        base_offset_size = sizes[1] >> 4
+        index_size = sizes[1] & 0x0F if version in (1, 2) else 0
+        id_size = 2 if version < 2 else 4
+        item_count = HeifReader.read_uint(file, id_size)
+        if item_count > HeifReader.MAX_ITEMS:
+            raise MetadataReader.CouldNotParseException("Corrupted iloc")
+        for _ in range(item_count):
+            current_id = HeifReader.read_uint(file, id_size)
+            construction_method = HeifReader.read_uint(file, 2) & 0x0F if version in (1, 2) else 0
+            file.seek(2, os.SEEK_CUR) # data_reference_index
+            base_offset = HeifReader.read_uint(file, base_offset_size)
+            extents = []
+            for _ in range(HeifReader.read_uint(file, 2)):
+                file.seek(index_size, os.SEEK_CUR) # extent_index
+                extents.append((HeifReader.read_uint(file, offset_size), HeifReader.read_uint(file, length_size)))
+            if current_id == item_id:
+                return construction_method, base_offset, extents
+            if file.tell() > end:
+                break
+        return None
+
+    # Reads the bytes of an item, either from the file (construction method 0) or from meta/idat (construction method 1)
+    @staticmethod
+    def read_item(file, meta_start, meta_end, construction_method, base_offset, extents):
+        if construction_method == 0:
+            origin = 0
+        elif construction_method == 1:
+            idat = IsoBmffReader.find_box(file, meta_start, meta_end, b'idat')
+            if idat is None:
+                raise MetadataReader.CouldNotParseException("meta/idat not found")
+            origin = idat[0]
+        else:
+            raise MetadataReader.CouldNotParseException("Unsupported iloc construction method")
+        if not extents or sum(length for _, length in extents) > HeifReader.MAX_EXIF_SIZE or any(length == 0 for _, length in extents):
+            raise MetadataReader.CouldNotParseException("Invalid Exif item extents")
+
+        data = bytearray()
+        for offset, length in extents:
+            file.seek(origin + base_offset + offset)
+            data += file.read(length)
+        return bytes(data)
+
+    @staticmethod
+    def read_uint(file, size):
+        if size == 0:
+            return 0
+        data = file.read(size)
+        if len(data) < size:
+            raise MetadataReader.CouldNotParseException("Truncated box")
+        return int.from_bytes(data, 'big')
+
+
+
+##################################################################
+# MEDIA PROCESSOR >> VIDEO PROCESSOR
+##################################################################
+class VideoProcessor(MediaProcessor):
+    def process(self, file_path):
+        if self.file_format is None and not self.is_supported(file_path):
+            raise MediaProcessor.FileTypeNotSupportedException("File type is not supported")
+        return self.get_capture_date(file_path)
+        if self.is_supported(file_path):
+            return self
+        else:
+            return None
+
+    def is_supported(self, file_path):
+        '''
+        Check if file is supported (i.e. a video)
+        Current support only includes video formats that typically store capture dates in the format "%Y-%m-%d %H:%M:%S"
+        '''
+        file_extension = os.path.splitext(file_path)[1].lower()
+        return file_extension in FileTriage.VIDEO_EXTENSIONS
+
+    def get_capture_date(self, file_path):
+        try:
+            # Fast path: read the creation date straight from the container's header
+            try:
+                capture_date = self.get_container_creation_date(file_path)
+                metrics.count("video.container_reader")
+            except MetadataReader.CouldNotParseException:
+                capture_date = self.get_hachoir_creation_date(file_path)
+            if capture_date:
+                date = capture_date.strftime(DATE_FORMAT)
+                time = capture_date.strftime(TIME_FORMAT)
+                if self.is_valid_datetime(date, time):
+                    return (date, time)
+        except Exception as e:
+            # Handle all exceptions gracefully
+            pass
+
+        # Delegate to im_feeling_lucky or just assume a capture date was not found
+        if (IM_FEELING_LUCKY):
+            return self.im_feeling_lucky(file_path)
+        else:
+            raise MediaProcessor.CouldNotExtractCaptureDateException("Could not extract a capture date")
+
+    def get_container_creation_date(self, file_path):
+        file_format = self.file_format or FileTriage.classify(file_path).file_format
+        if file_format == 'mp4':
+            return IsoBmffReader.get_creation_date(file_path)
+        if file_format == 'matroska':
+            return MatroskaReader.get_creation_date(file_path)
+        raise MetadataReader.CouldNotParseException("No container reader for this file type")
+
+    # Slow path: let hachoir parse the whole file
+    def get_hachoir_creation_date(self, file_path):
+        started = perf_counter()
+        parser = createParser(file_path)
+        if not parser:
+            return None
+        with parser:
+            metadata = extractMetadata(parser)
+        metrics.observe("video.hachoir", perf_counter() - started)
+        if not metadata or not metadata.has('creation_date'):
+            return None
+        capture_date = metadata.get('creation_date')
+        return capture_date if isinstance(capture_date, datetime) else None
+
+
+
+##################################################################
+# METADATA READER >> ISO BMFF READER
+##################################################################
+class IsoBmffReader(MetadataReader):
+    '''
+    Walks the boxes of ISO base media files (MP4, MOV, M4V) up to moov/mvhd and reads its creation_time.
+    Boxes are skipped by seeking over them, so only a few bytes are read even when moov is at the end of the file
+    '''
+    MAC_EPOCH = datetime(1904, 1, 1) # mvhd times are seconds since 1904-01-01 (UTC)
+    TOP_LEVEL_BOXES = (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid')
+    MAX_BOXES = 1024
+
+    @staticmethod
+    def get_creation_date(file_path):
+        '''
+        Returns the creation date as a (UTC) datetime or None if the file has none.
+        Raises CouldNotParseException if the file is not laid out as expected
+        '''
+        try:
+            with open(file_path, 'rb') as file:
+                file_size = os.fstat(file.fileno()).st_size
+                for box_type, start, end in IsoBmffReader.iter_boxes(file, 0, file_size):
+                    if box_type not in IsoBmffReader.TOP_LEVEL_BOXES:
+                        raise MetadataReader.CouldNotParseException("Not an ISO base media file")
+                    if box_type == b'moov':
+                        mvhd = IsoBmffReader.find_box(file, start, end, b'mvhd')
+                        if mvhd is None:
+                            break
+                        return IsoBmffReader.read_mvhd_creation_date(file, mvhd[0])
+        except (OSError, struct.error) as e:
+            raise MetadataReader.CouldNotParseException(str(e))
+        raise MetadataReader.CouldNotParseException("moov/mvhd not found")
+
+    # Yields (box_type, payload_start, box_end) for every box within [start, end)
+    @staticmethod
+    def iter_boxes(file, start, end):
+        offset = start
+        for _ in range(IsoBmffReader.MAX_BOXES):
+            if offset + 8 > end:
+                return
+            file.seek(offset)
+            size, box_type = struct.unpack('>I4s', file.read(8))
+            header_size = 8
+            if size == 1:
+                # 64 bit size
+                size = struct.unpack('>Q', file.read(8))[0]
+                header_size = 16
+            elif size == 0:
+                # Box extends to the end of its parent
+                size = end - offset
+            if size < header_size:
+                raise MetadataReader.CouldNotParseException("Invalid box size")
+            yield box_type, offset + header_size, offset + size
+            offset += size
+
+    # Returns the (payload_start, box_end) of the first box_type found within [start, end)
+    @staticmethod
+    def find_box(file, start, end, box_type):
+        for found_type, payload_start, box_end in IsoBmffReader.iter_boxes(file, start, end):
+            if found_type == box_type:
+                return (payload_start, box_end)
+        return None
+
+    @staticmethod
+    def read_mvhd_creation_date(file, payload_start):
+        file.seek(payload_start)
+        version = file.read(4)[0]
+        if version == 1:
+            creation_time = struct.unpack('>Q', file.read(8))[0]
+        else:
+            creation_time = struct.unpack('>I', file.read(4))[0]
+        if creation_time == 0:
+            # Not set by the writer
+            return None
+        return IsoBmffReader.MAC_EPOCH + timedelta(seconds=creation_time)
+
+
+
+##################################################################
+# METADATA READER >> MATROSKA READER
+##################################################################
+class MatroskaReader(MetadataReader):
+    '''
+    Walks the EBML elements of Matroska files (MKV, WebM) up to Segment/Info/DateUTC.
+    Clusters (i.e. the actual audio and video) are never read
+    '''
+    MATROSKA_EPOCH = datetime(2001, 1, 1) # DateUTC is the number of nanoseconds since 2001-01-01 (UTC)
+
+    ID_EBML     = 0x1A45DFA3
+    ID_SEGMENT  = 0x18538067
+    ID_INFO     = 0x1549A966
+    ID_DATE_UTC = 0x4461
+    ID_CLUSTER  = 0x1F43B675
+
+    MAX_ELEMENTS = 256
+
+    @staticmethod
+    def get_creation_date(file_path):
+        '''
+        Returns the creation date as a (UTC) datetime or None if the file has none.
+        Raises CouldNotParseException if the file is not laid out as expected
+        '''
+        try:
+            with open(file_path, 'rb') as file:
+                file_size = os.fstat(file.fileno()).st_size
+                elements = MatroskaReader.iter_elements(file, 0, file_size)
+                element_id, start, end = next(elements)
+                if element_id != MatroskaReader.ID_EBML:
+                    raise MetadataReader.CouldNotParseException("Not a Matroska file")
+                for element_id, start, end in elements:
+                    if element_id == MatroskaReader.ID_SEGMENT:
+                        return MatroskaReader.read_segment_date(file, start, end)
+        except (OSError, IndexError, StopIteration) as e:
+            raise MetadataReader.CouldNotParseException(str(e))
+        raise MetadataReader.CouldNotParseException("Segment not found")
+
+    @staticmethod
+    def read_segment_date(file, start, end):
+        for element_id, info_start, info_end in MatroskaReader.iter_elements(file, start, end):
+            if element_id == MatroskaReader.ID_CLUSTER:
+                # Info always precedes the clusters
+                return None
+            if element_id == MatroskaReader.ID_INFO:
+                for child_id, child_start, child_end in MatroskaReader.iter_elements(file, info_start, info_end):
+                    if child_id == MatroskaReader.ID_DATE_UTC:
+                        file.seek(child_start)
+                        nanoseconds = int.from_bytes(file.read(child_end - child_start), 'big', signed=True)
+                        return MatroskaReader.MATROSKA_EPOCH + timedelta(microseconds=nanoseconds // 1000)
+                return None
+        return None
+
+    # Yields (element_id, data_start, data_end) for every element within [start, end)
+    @staticmethod
+    def iter_elements(file, start, end):
+        offset = start
+        for _ in range(MatroskaReader.MAX_ELEMENTS):
+            if offset >= end:
+                return
+            file.seek(offset)
+            element_id, id_length = MatroskaReader.read_vint(file, keep_marker=True)
+            size, size_length = MatroskaReader.read_vint(file, keep_marker=False)
+            data_start = offset + id_length + size_length
+            if size == (1 << (7 * size_length)) - 1:
+                # Unknown size (e.g. live streams): only acceptable for the segment, which spans the rest of the file
+                if element_id != MatroskaReader.ID_SEGMENT:
+                    raise MetadataReader.CouldNotParseException("Element of unknown size")
+                size = end - data_start
+            yield element_id, data_start, min(data_start + size, end)
+            offset = data_start + size
+
+    # Reads an EBML variable length integer, returning (value, length in bytes)
+    @staticmethod
+    def read_vint(file, keep_marker):
+        first = file.read(1)[0]
+        length = 8 - first.bit_length() + 1
+        if length > 8:
+            raise MetadataReader.CouldNotParseException("Invalid variable length integer")
+        value = first if keep_marker else first & ((1 << (8 - length)) - 1)
+        for byte in file.read(length - 1):
+            value = (value << 8) | byte
+        return value, length
+
+
+
+##################################################################
+# SHARD
+##################################################################
+class Shard():
+    '''
+    Shard I of N of a sharded run (--shard I/N), to spread the ingest across processes or hosts sharing the folder:
+    the files whose path (relative to the folder where the script runs) hashes to I. Every shard walks the whole
+    folder but only ingests its own files, on a manifest, a journal and a metadata cache of its own (in _Media Vault/_shards).
+    Nothing is moved until the merge (--merge N), which organizes the files of every shard at once, as a single run would.
+    Each shard (and the merge, which holds all of them) takes a lock file, so that runs never race on the same files
+    '''
+    FOLDER = "_shards"
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        prefix = os.getcwd() + "/" + "_Media Vault" + "/" + Shard.FOLDER + "/" + f"shard-{index}-of-{count}"
+        self.manifestFile = prefix + ".sqlite"
+        self.journalFile = prefix + ".jsonl"
+        self.cacheFile = prefix + "_cache.sqlite"
+        self.metricsFile = prefix + "_" + (METRICS_REPORT_FILE or "").lstrip("_")
+        self.lockFile = prefix + ".lock"
+
+    @staticmethod
+    def all(count):
+        return [Shard(index, count) for index in range(1, count + 1)]
+
+    # Whether a file belongs to the shard
+    def owns(self, file_path):
+        relativePath = os.path.relpath(file_path).replace(os.sep, "/")
+        digest = hashlib.blake2b(relativePath.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % self.count == self.index - 1
+
+    # Exits unless the last run of every shard ingested its files (and they were not merged yet)
+    @staticmethod
+    def checkIngested(shards):
+        pending = [shard for shard in shards if not os.path.exists(shard.manifestFile)
+                   or not {"ingested", "end"} <= Journal.lastRunRecords(shard.journalFile)]
+        if pending:
+            logger.error(f"Halting. Shard(s) {', '.join(str(shard.index) for shard in pending)} of {shards[0].count} have not ingested their files (run them with --shard I/{shards[0].count} first).")
+            sys.exit(1)
+
+    # Takes a lock file (created atomically, which holds on network file systems too) or exits if it is taken.
+    # takeOver --> the lock left by an interrupted run is taken over when resuming it
+    @staticmethod
+    def lock(lockFile, takeOver=False):
+        import socket # Only needed here
+        os.makedirs(os.path.dirname(lockFile), exist_ok=True)
+        try:
+            descriptor = os.open(lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not takeOver:
+                with open(lockFile, "r") as file:
+                    holder = file.read().strip()
+                logger.error(f"Halting. {os.path.basename(lockFile)} is held by {holder}. If that run was interrupted, resume it with --resume.")
+                sys.exit(1)
+            descriptor = os.open(lockFile, os.O_WRONLY | os.O_TRUNC)
+        with os.fdopen(descriptor, "w") as file:
+            file.write(f"{socket.gethostname()} (pid {os.getpid()})\n")
+
+    @staticmethod
+    def unlock(lockFile):
+        if os.path.exists(lockFile):
+            os.remove(lockFile)
+
+
+
+##################################################################
+# REVERT
+##################################################################
+class Revert():
+    '''
+    This mode reverts the operations of MediaVault.py, restoring the new file paths to their previous state.
+    By default the last run is reverted; runs can also be picked by ID ("all" for every run) or by the date they started,
+    and only the files under a path prefix can be reverted (use it to keep some of the changes).
+    The _log.md written by older versions is reverted with every run, or as the last run once the journal has none left.
+    Moves are undone last first, on a thread pool, and the moves sharing a path are kept in order
+    '''
+    JOURNAL_FILE = "./_Media Vault/_journal.jsonl"
+    LEGACY_LOG_FILE = "./_Media Vault/_log.md"
+    DAY_COUNTER_FILE = "./_Media Vault/_days.sqlite"
+
+    def __init__(self, runId=None, since=None, until=None, prefix=None):
+        self.runId = runId
+        self.since = since
+        self.until = until
+        self.prefix = os.path.abspath(prefix) if prefix else None
+
+    def run(self):
+        logger.info("Starting revert operation.")
+        entries = Journal.readIndex(Revert.JOURNAL_FILE) if os.path.exists(Revert.JOURNAL_FILE) else []
+        runs = self.selectRuns(entries)
+        # The markdown log written by older versions of the script predates every run
+        legacy = (self.runId == "all" or (self.runId is None and not runs)) and not (self.since or self.until) \
+            and os.path.exists(Revert.LEGACY_LOG_FILE)
+        if not runs and not legacy:
+            logger.info("Nothing to revert.")
+            return
+
+        reverted = self.revertMoves(self.moves(runs, entries, legacy))
+        # The watch mode counts files per date: rebuild them from the vault on its next start
+        if reverted and os.path.exists(Revert.DAY_COUNTER_FILE):
+            os.remove(Revert.DAY_COUNTER_FILE)
+        if not self.prefix:
+            for runId in runs:
+                Journal.markReverted(Revert.JOURNAL_FILE, runId)
+        logger.info(f"Reverted {reverted} files from {len(runs)} run(s){' and the legacy log' if legacy else ''}.")
+        logger.info("Success ;)")
+
+
+    # Returns the IDs of the runs to revert, last run first
+    def selectRuns(self, entries):
+        reverted = {entry.run for entry in entries if entry.kind == "revert"}
+        starts = [entry for entry in entries if entry.kind == "start" and entry.run not in reverted]
+        if self.runId not in (None, "all"):
+            if self.runId not in {entry.run for entry in entries if entry.kind == "start"}:
+                logger.error(f"There is no run {self.runId} in the journal.")
+                sys.exit(1)
+            starts = [entry for entry in starts if entry.run == self.runId]
+        # ISO timestamps compare as strings; a date compares with the start of the timestamps
+        if self.since:
+            starts = [entry for entry in starts if entry.time >= self.since]
+        if self.until:
+            starts = [entry for entry in starts if entry.time[:len(self.until)] <= self.until]
+        if self.runId is None and not (self.since or self.until):
+            starts = starts[-1:]
+        return [entry.run for entry in reversed(starts)]
+
+
+    # Yields the (old path, new path) of the moves to undo, last move first
+    def moves(self, runs, entries, legacy):
+        for runId in runs:
+            for old_path, new_path in Journal.committedMoves(Revert.JOURNAL_FILE, runId, entries):
+                if self.selected(old_path, new_path):
+                    yield old_path, new_path
+        if legacy:
+            for line in Journal.reversedLines(Revert.LEGACY_LOG_FILE):
+                # Split the line by the pipe character '|' (the header rows are not moves)
+                parts = [part.strip() for part in line.decode("utf-8").split("|") if part.strip()]
+                if len(parts) >= 2 and parts[0] != "Old File Path" and not parts[0].startswith("---"):
+                    if self.selected(parts[0], parts[1]):
+                        yield parts[0], parts[1]
+
+
+    def selected(self, old_path, new_path):
+        return not self.prefix or any(path == self.prefix or path.startswith(self.prefix + os.sep) for path in (old_path, new_path))
+
+
+    # Undoes the moves on a thread pool, each move waiting for the previous moves to or from the same paths
+    def revertMoves(self, moves):
+        transferEngine = TransferEngine(NR_CONCURRENT_COPIES)
+        lastMove = {}  # path --> the last scheduled move touching it
+        inFlight = deque()
+        reverted = 0
+        with ThreadPoolExecutor(NR_MOVE_THREADS) as executor:
+            for old_path, new_path in moves:
+                dependencies = [lastMove[path] for path in (new_path, old_path) if path in lastMove]
+                move = executor.submit(Revert.revertMove, transferEngine, new_path, old_path, dependencies)
+                lastMove[new_path] = lastMove[old_path] = move
+                inFlight.append((move, old_path, new_path))
+                if len(inFlight) >= NR_MOVE_THREADS * MOVES_IN_FLIGHT_PER_THREAD:
+                    reverted += Revert.completeMove(lastMove, *inFlight.popleft())
+            while inFlight:
+                reverted += Revert.completeMove(lastMove, *inFlight.popleft())
+        transferEngine.report()
+        return reverted
+
+
+    @staticmethod
+    def completeMove(lastMove, move, old_path, new_path):
+        for path in (old_path, new_path):
+            if lastMove.get(path) is move:
+                del lastMove[path]
+        return move.result()
+
+
+    # Moves new_path back to old_path (returns whether the file was moved)
+    @staticmethod
+    def revertMove(transferEngine, new_path, old_path, dependencies):
+        for dependency in dependencies:
+            dependency.result()
+        try:
+            if not os.path.exists(new_path):
+                # File does not exist
+                return False
+            if os.path.exists(old_path):
+                logger.error(f"Will not revert {new_path} as {old_path} already exists.")
+                return False
+            os.makedirs(os.path.dirname(old_path), exist_ok=True)
+            strategy = transferEngine.move(new_path, old_path)
+            logger.debug(f"Moved {new_path} to {old_path} ({strategy})")
+            return True
+        except Exception as e:
+            logger.error(f"An error occurred while processing {new_path}: {e}")
+            return False
+
+
+##################################################################
+# EXECUTION
+##################################################################
+# Runs the command in a child interpreter that reports the import time of every module (-X importtime)
+# and sums it up per top level module. Returns the exit status (1 if an import went over its budget)
+def startupProfile(argv):
+    import subprocess  # Only needed here
+    scriptFolder, scriptName = os.path.split(os.path.abspath(__file__))
+    module = os.path.splitext(scriptName)[0]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [scriptFolder, os.environ.get("PYTHONPATH")])))
+    command = [sys.executable, "-X", "importtime", "-c", f"import {module}; {module}.main()"] + argv
+    started = perf_counter()
+    child = subprocess.run(command, stderr=subprocess.PIPE, text=True, env=env)
+    elapsed = perf_counter() - started
+
+    importTimes = {}  # top level module --> microseconds
+    for line in child.stderr.splitlines():
+        if not line.startswith("import time:"):
+            print(line, file=sys.stderr)
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue  # header
+        topLevel = fields[2].strip().split(".")[0]
+        importTimes[topLevel] = importTimes.get(topLevel, 0) + int(fields[0])
+    importTimes["total"] = sum(importTimes.values())
+
+    print("| Module | Import time (ms) | Budget (ms) |")
+    print("| ------ | ---------------- | ----------- |")
+    for name, microseconds in sorted(importTimes.items(), key=lambda item: -item[1])[:25]:
+        print(f"| {name} | {microseconds / 1000:.1f} | {STARTUP_PROFILE_THRESHOLDS.get(name, '')} |")
+    print(f"Command took {elapsed * 1000:.1f} ms (exit status {child.returncode}).")
+
+    overBudget = [name for name, budget in STARTUP_PROFILE_THRESHOLDS.items() if importTimes.get(name, 0) / 1000 > budget]
+    for name in overBudget:
+        logger.error(f"Importing {name} took {importTimes[name] / 1000:.1f} ms (budget: {STARTUP_PROFILE_THRESHOLDS[name]} ms).")
+    return 1 if overBudget else child.returncode
+
+
+def shardSpec(value):
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"{value} is not a shard (I/N, with 1 <= I <= N)")
+    return int(match.group(1)), int(match.group(2))
+
+
+def isoDate(value):
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a date (YYYY-MM-DD[THH:MM:SS])")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Media Vault Script")
+    parser.add_argument("--revert", "-r", action="store_true", help="revert the operation")
+    parser.add_argument("--workers", "-w", type=int, default=NR_WORKERS, help="number of ingest worker processes (0 = all cores)")
+    parser.add_argument("--stream", "-s", action="store_true", default=STREAMING_PIPELINE, help="move files while the folder is still being scanned")
+    parser.add_argument("--resume", action="store_true", help="resume the last run, if it was interrupted")
+    parser.add_argument("--watch", action="store_true", help="keep running and organize the files as they land on the folder")
+    parser.add_argument("--shard", type=shardSpec, help="only ingest shard I of N (I/N) of the files, to be organized by --merge N")
+    parser.add_argument("--merge", type=int, help="organize the files ingested by the N shards of a sharded run")
+    parser.add_argument("--low-memory", action="store_true", default=LOW_MEMORY, help="keep memory usage within MEMORY_LIMIT, for very large libraries")
+    parser.add_argument("--run", help="with --revert: ID of the run to revert (default: the last run; all = every run)")
+    parser.add_argument("--since", type=isoDate, help="with --revert: revert the runs started on or after this date (YYYY-MM-DD[THH:MM:SS])")
+    parser.add_argument("--until", type=isoDate, help="with --revert: revert the runs started on or before this date (YYYY-MM-DD[THH:MM:SS])")
+    parser.add_argument("--prefix", help="with --revert: only revert the files moved from or to this folder")
+    parser.add_argument("--startup-profile", action="store_true", help="report the import time of each module while running the command")
+    args = parser.parse_args()
+    if args.startup_profile:
+        sys.exit(startupProfile([arg for arg in sys.argv[1:] if arg != "--startup-profile"]))
+    if args.resume and args.stream:
+        parser.error("--resume is not supported by the streaming pipeline (just run it again)")
+    if args.watch and (args.revert or args.resume or args.stream):
+        parser.error("--watch cannot be combined with --revert, --resume or --stream")
+    if (args.shard or args.merge) and (args.revert or args.stream or args.watch):
+        parser.error("--shard and --merge cannot be combined with --revert, --stream or --watch")
+    if args.shard and args.merge:
+        parser.error("--shard and --merge are separate steps of a sharded run")
+    if args.merge is not None and args.merge < 1:
+        parser.error("--merge takes the number of shards (N >= 1)")
+    if not args.revert and (args.run or args.since or args.until or args.prefix):
+        parser.error("--run, --since, --until and --prefix can only be used with --revert")
+
+    if args.low_memory:
+        memoryBudget.enable()
+
+    if args.revert:
+        revert = Revert(runId=args.run, since=args.since, until=args.until, prefix=args.prefix)
+        revert.run()
+    else:
+        mediaVault = MediaVault(workers=args.workers, streaming=args.stream, resume=args.resume, shard=args.shard, merge=args.merge)
+        if args.watch:
+            mediaVault.watch()
+        else:
+            mediaVault.run()
+
+
+
+if __name__ == "__main__":
+    main()
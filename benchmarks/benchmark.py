@@ -0,0 +1,299 @@
+'''
+Benchmarks MediaVault.py on a synthetic media corpus.
+
+The corpus is generated offline and is reproducible (same scale and seed --> same files): JPEGs with and without
+Exif, TIFF based RAW stand-ins, minimal MP4/MOV containers with an mvhd creation date, files that can only be dated
+from their filename (lucky patterns) and junk files.
+
+Ingest, organize and revert run on separate processes, so that the files/sec and the peak RSS of each phase are
+measured on their own. Results are printed (or saved) as JSON, to be compared between commits:
+
+python3 benchmarks/benchmark.py --scale 1k --output before.json
+python3 benchmarks/benchmark.py --scale 1k --output after.json
+python3 benchmarks/benchmark.py --compare before.json after.json
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+from datetime import datetime, timedelta
+from time import perf_counter
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000, "1M": 1000000}
+PHASES = ["ingest", "organize", "revert"]
+
+FILES_PER_FOLDER = 1000
+
+# kind --> share of the corpus
+CORPUS_MIX = [
+    ("jpeg_exif", 0.40),
+    ("jpeg_no_exif", 0.05),
+    ("raw", 0.10),
+    ("mp4", 0.12),
+    ("mov", 0.05),
+    ("lucky", 0.18),
+    ("junk", 0.10),
+]
+
+LUCKY_FILENAMES = [
+    "IMG_{Y}{m}{d}_{H}{M}{S}.jpg",
+    "IMG-{Y}{m}{d}-WA{n:04d}.jpg",
+    "VID-{Y}{m}{d}-WA{n:04d}.mp4",
+    "WhatsApp Image {Y}-{m}-{d} at {H}.{M}.{S}.jpeg",
+    "Screenshot_{Y}{m}{d}-{H}{M}{S}.png",
+    "{Y}{m}{d}_{H}{M}{S}.jpg",
+]
+JUNK_FILENAMES = ["notes {n}.txt", "sidecar {n}.xmp", "random {n}.jpg", "backup {n}.zip", ".DS_Store"]
+
+MAC_EPOCH = datetime(1904, 1, 1)
+
+
+
+##################################################################
+# CORPUS GENERATOR
+##################################################################
+def tiff(capture_date, byte_order='>'):
+    '''
+    TIFF header, IFD0 with a pointer to the Exif IFD, and the Exif IFD with DateTimeOriginal (0x9003)
+    '''
+    value = capture_date.strftime("%Y:%m:%d %H:%M:%S").encode() + b'\x00'
+    signature = b'MM\x00*' if byte_order == '>' else b'II*\x00'
+    out = signature + struct.pack(byte_order + 'I', 8)
+    out += struct.pack(byte_order + 'H', 1) + struct.pack(byte_order + 'HHII', 0x8769, 4, 1, 26) + struct.pack(byte_order + 'I', 0)
+    out += struct.pack(byte_order + 'H', 1) + struct.pack(byte_order + 'HHII', 0x9003, 2, len(value), 44) + struct.pack(byte_order + 'I', 0)
+    return out + value
+
+
+def segment(marker, payload):
+    return b'\xff' + marker + struct.pack('>H', len(payload) + 2) + payload
+
+
+def jpeg(capture_date=None, payload=256):
+    '''
+    8x8 grey baseline JPEG that PIL can decode: one quantization table, one Huffman table each for DC and AC (a single
+    code, for "no difference" and "end of block") and a scan of one block, followed by payload bytes of a comment
+    '''
+    out = b'\xff\xd8' + segment(b'\xe0', b'JFIF\x00' + b'\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+    if capture_date:
+        out += segment(b'\xe1', b'Exif\x00\x00' + tiff(capture_date))
+    out += segment(b'\xfe', b'\x00' * payload)
+    out += segment(b'\xdb', b'\x00' + b'\x01' * 64)
+    out += segment(b'\xc0', b'\x08' + struct.pack('>HH', 8, 8) + b'\x01' + b'\x01\x11\x00')
+    out += segment(b'\xc4', b'\x00' + b'\x01' + b'\x00' * 15 + b'\x00')
+    out += segment(b'\xc4', b'\x10' + b'\x01' + b'\x00' * 15 + b'\x00')
+    out += segment(b'\xda', b'\x01' + b'\x01\x00' + b'\x00\x3f\x00')
+    # DC "0" and AC end of block "0", padded with ones
+    return out + b'\x3f' + b'\xff\xd9'
+
+
+def png():
+    '''
+    8x8 grey PNG (PNG files have no Exif date)
+    '''
+    def chunk(chunk_type, payload):
+        return struct.pack('>I', len(payload)) + chunk_type + payload + struct.pack('>I', zlib.crc32(chunk_type + payload))
+    header = struct.pack('>IIBBBBB', 8, 8, 8, 0, 0, 0, 0)
+    # Each row: filter type (none) and 8 pixels
+    pixels = zlib.compress((b'\x00' + b'\x80' * 8) * 8)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', pixels) + chunk(b'IEND', b'')
+
+
+def raw(capture_date, payload=512):
+    return tiff(capture_date, '<') + b'\x00' * payload
+
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def isoBmff(capture_date, brand=b'isom', payload=1024):
+    # A capture date of None leaves the creation time unset (0)
+    seconds = int((capture_date - MAC_EPOCH).total_seconds()) if capture_date else 0
+    mvhd = box(b'mvhd', b'\x00\x00\x00\x00' + struct.pack('>II', seconds, seconds) + struct.pack('>II', 1000, 0) + b'\x00' * 80)
+    ftyp = box(b'ftyp', brand + b'\x00\x00\x02\x00' + brand + b'mp41')
+    return ftyp + box(b'moov', mvhd) + box(b'mdat', b'\x00' * payload)
+
+
+def captureDates(random_generator, count):
+    '''
+    Capture dates clustered on days (some days hold enough files to get a folder of their own)
+    '''
+    days = [datetime(2015, 1, 1) + timedelta(days=random_generator.randrange(10 * 365)) for _ in range(max(1, count // 20))]
+    for _ in range(count):
+        yield random_generator.choice(days) + timedelta(seconds=random_generator.randrange(24 * 3600))
+
+
+def generateCorpus(folder, nrFiles, seed=0):
+    random_generator = random.Random(seed)
+    kinds = [kind for kind, _ in CORPUS_MIX]
+    weights = [share for _, share in CORPUS_MIX]
+    counts = dict.fromkeys(kinds, 0)
+    for n, capture_date in enumerate(captureDates(random_generator, nrFiles)):
+        subfolder = os.path.join(folder, f"{n // FILES_PER_FOLDER // 10:03d}", f"{n // FILES_PER_FOLDER:05d}")
+        if n % FILES_PER_FOLDER == 0:
+            os.makedirs(subfolder, exist_ok=True)
+        kind = random_generator.choices(kinds, weights)[0]
+        counts[kind] += 1
+        fields = dict(Y=f"{capture_date.year:04d}", m=f"{capture_date.month:02d}", d=f"{capture_date.day:02d}",
+                      H=f"{capture_date.hour:02d}", M=f"{capture_date.minute:02d}", S=f"{capture_date.second:02d}", n=n)
+        if kind == "jpeg_exif":
+            filename, content = f"DSC{n:07d}.jpg", jpeg(capture_date)
+        elif kind == "jpeg_no_exif":
+            filename, content = f"photo {n}.jpg", jpeg()
+        elif kind == "raw":
+            filename, content = f"DSC{n:07d}.{random_generator.choice(['dng', 'nef'])}", raw(capture_date)
+        elif kind == "mp4":
+            filename, content = f"MVI{n:07d}.mp4", isoBmff(capture_date)
+        elif kind == "mov":
+            filename, content = f"MVI{n:07d}.mov", isoBmff(capture_date, brand=b'qt  ')
+        elif kind == "lucky":
+            filename = random_generator.choice(LUCKY_FILENAMES).format(**fields)
+            # A valid file without a capture date on its metadata, so that only its filename can date it
+            content = isoBmff(None) if filename.endswith(".mp4") else png() if filename.endswith(".png") else jpeg()
+        else:
+            filename, content = random_generator.choice(JUNK_FILENAMES).format(**fields), os.urandom(64)
+        path = os.path.join(subfolder, filename)
+        if os.path.exists(path):
+            # Lucky and junk filenames may repeat within a folder
+            path = os.path.join(subfolder, f"{n} {filename}")
+        with open(path, "wb") as file:
+            file.write(content)
+    return counts
+
+
+
+##################################################################
+# PHASES (each one runs on a process of its own)
+##################################################################
+def peakRss():
+    '''
+    Peak resident set size in KB, of this process and of its (worker) children
+    '''
+    scale = 1 if sys.platform.startswith("linux") else 1 / 1024  # ru_maxrss is in bytes on macOS
+    return int(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale)
+
+
+def runPhase(phase, corpus, workers, lowMemory):
+    sys.path.insert(0, REPOSITORY_FOLDER)
+    import MediaVault
+    os.chdir(corpus)
+    if lowMemory:
+        MediaVault.memoryBudget.enable()
+
+    started = perf_counter()
+    if phase == "ingest":
+        vault = MediaVault.MediaVault(workers=workers)
+        vault.organizer.ingestFiles(vault.scan(), workers)
+        vault.organizer.manifest.flush()
+        vault.organizer.journal.markIngested()
+        nrFiles = sum(vault.organizer.formatCounter.values())
+        vault.organizer.close()
+    elif phase == "organize":
+        # Picks up the run the ingest phase left behind
+        vault = MediaVault.MediaVault(workers=workers, resume=True)
+        nrFiles = sum(vault.organizer.manifest.dateCounts().values())
+        vault.run()
+    else:
+        nrFiles = sum(1 for record in MediaVault.Journal.records(MediaVault.Revert.JOURNAL_FILE) if record["type"] == "commit")
+        started = perf_counter()
+        MediaVault.Revert().run()
+    elapsed = perf_counter() - started
+
+    print(json.dumps({"phase": phase, "files": nrFiles, "seconds": round(elapsed, 3),
+                      "files_per_sec": round(nrFiles / elapsed, 1) if elapsed else None, "peak_rss_kb": peakRss()}))
+
+
+def commitId():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_FOLDER,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    nrFiles = SCALES.get(args.scale) or int(args.scale)
+    corpus = args.corpus or tempfile.mkdtemp(prefix="mediavault-benchmark-")
+    try:
+        started = perf_counter()
+        counts = generateCorpus(corpus, nrFiles, args.seed)
+        results = {"commit": commitId(), "python": platform.python_version(), "platform": platform.platform(),
+                   "scale": nrFiles, "seed": args.seed, "workers": args.workers, "low_memory": args.low_memory, "corpus": counts,
+                   "corpus_seconds": round(perf_counter() - started, 3), "phases": {}}
+
+        for phase in PHASES:
+            command = [sys.executable, os.path.abspath(__file__), "--phase", phase, "--corpus", corpus, "--workers", str(args.workers)]
+            child = subprocess.run(command + (["--low-memory"] if args.low_memory else []), capture_output=True, text=True)
+            if child.returncode != 0:
+                sys.stderr.write(child.stderr)
+                sys.exit(f"The {phase} phase failed.")
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            results["phases"][phase] = {key: value for key, value in result.items() if key != "phase"}
+            print(f"{phase}: {result['files']} files in {result['seconds']} s "
+                  f"({result['files_per_sec']} files/s, peak RSS {result['peak_rss_kb'] // 1024} MB)", file=sys.stderr)
+    finally:
+        if not args.keep:
+            shutil.rmtree(corpus, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(before, after):
+    with open(before) as file:
+        old = json.load(file)
+    with open(after) as file:
+        new = json.load(file)
+    print(f"| Phase | Metric | {old.get('commit')} | {new.get('commit')} | Change |")
+    print("| ----- | ------ | ------ | ------ | ------ |")
+    for phase in PHASES:
+        for metric in ["files_per_sec", "peak_rss_kb"]:
+            oldValue = old["phases"].get(phase, {}).get(metric)
+            newValue = new["phases"].get(phase, {}).get(metric)
+            change = f"{(newValue - oldValue) / oldValue:+.1%}" if oldValue and newValue is not None else ""
+            print(f"| {phase} | {metric} | {oldValue} | {newValue} | {change} |")
+
+
+
+##################################################################
+# EXECUTION
+##################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Media Vault benchmarks")
+    parser.add_argument("--scale", default="1k", help="number of files on the corpus: 1k, 10k, 100k, 1M or any number")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus generator")
+    parser.add_argument("--workers", "-w", type=int, default=1, help="number of ingest worker processes (0 = all cores)")
+    parser.add_argument("--low-memory", action="store_true", help="run MediaVault.py in low memory mode")
+    parser.add_argument("--corpus", help="folder where the corpus is generated (default: a temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="keep the corpus after the benchmark")
+    parser.add_argument("--output", "-o", help="file where the JSON results are saved (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON results")
+    parser.add_argument("--phase", choices=PHASES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.phase:
+        runPhase(args.phase, args.corpus, args.workers, args.low_memory)
+    else:
+        benchmark(args)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# MediaVault.py lives at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The corpus generator of the benchmarks writes the media files of the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
@@ -0,0 +1,63 @@
+import pytest
+
+import MediaVault
+from MediaVault import CSVManifest, MemoryBudget
+
+ROWS = [
+    ("/photos/b.jpg", "2021.07.08", "09.10.00", "2021.07.08"),
+    ("/photos/a.jpg", "2021.07.08", "02.00.00", "2021.07.07"),
+    ("/photos/lucky_2021-7-8.jpg", "2021.7.8", None, "2021.7.8"),
+    ("/photos/c.jpg", "2020.01.01", None, "2020.01.01"),
+    ("/photos/café.jpg", "2021.07.07", "23.59.59", "2021.07.07"),
+]
+
+
+@pytest.fixture
+def lowMemory(monkeypatch):
+    budget = MemoryBudget()
+    budget.enable()
+    monkeypatch.setattr(MediaVault, "memoryBudget", budget)
+    return budget
+
+
+def manifest(tmp_path, rows):
+    manifest = CSVManifest(str(tmp_path / "mediaVaultData.csv"))
+    for row in rows:
+        manifest.write(*row)
+    return manifest
+
+
+def expected(rows):
+    return [row for _, row in sorted(enumerate(rows), key=lambda item: (item[1][3], item[0]))]
+
+
+def test_read_sorts_by_relative_date_and_keeps_the_dates(tmp_path):
+    assert list(manifest(tmp_path, ROWS).read()) == expected(ROWS)
+
+
+def test_dates_that_would_not_render_back_the_same_are_not_packed(tmp_path):
+    packed = manifest(tmp_path, ROWS)
+    assert packed.datePlanner.pack("2021.07.08", "09.10.00") == packed.datePlanner.parseDate("2021.07.08") * 86400 + 9 * 3600 + 10 * 60
+    assert packed.datePlanner.pack("2021.07.08", None) == -packed.datePlanner.parseDate("2021.07.08")
+    assert packed.datePlanner.pack("2021.7.8", None) is None
+    assert packed.datePlanner.pack("2021.07.08", "9.10.00") is None
+
+
+def test_low_memory_read_spills_sorted_runs(tmp_path, lowMemory, monkeypatch):
+    lowMemory.limit = 0.001
+    rows = [(f"/photos/{n}.jpg", f"2021.07.{n % 28 + 1:02d}", "12.00.00", f"2021.07.{n % 28 + 1:02d}") for n in range(500)]
+    spilled = []
+    spill = CSVManifest.spill
+    monkeypatch.setattr(CSVManifest, "spill", lambda self, run: spilled.append(len(run)) or spill(self, run))
+    assert list(manifest(tmp_path, rows).read()) == expected(rows)
+    assert len(spilled) > 1
+
+
+def test_sort_runs_shrink_while_over_the_memory_limit(tmp_path, lowMemory, monkeypatch):
+    lowMemory.limit = 10 * MemoryBudget.MIN_SHARE / (1024 * 1024)
+    monkeypatch.setattr(MemoryBudget, "rss", staticmethod(lambda: lowMemory.limit + 1))
+    rows = [(f"/photos/{n}.jpg", "2021.07.08", "12.00.00", "2021.07.08") for n in range(MemoryBudget.CHECK_INTERVAL + 1)]
+    assert list(manifest(tmp_path, rows).read()) == rows
+    assert lowMemory.degraded == {"sort"}
+    assert lowMemory.degrade("sort", MemoryBudget.MIN_SHARE * 4) == MemoryBudget.MIN_SHARE * 2
+    assert lowMemory.degrade("sort", MemoryBudget.MIN_SHARE) == MemoryBudget.MIN_SHARE
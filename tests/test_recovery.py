@@ -0,0 +1,105 @@
+import errno
+import gc
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import MediaVault
+from benchmark import jpeg
+from MediaVault import TransferEngine
+
+
+class Crash(BaseException):
+    ''' Stands for the process being killed at the point it is raised '''
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sources = []
+    for n in range(3):
+        source = tmp_path / f"DSC{n}.jpg"
+        source.write_bytes(jpeg(datetime(2021, 7, 8, 9, 10, n)))
+        sources.append(str(source))
+    return sources
+
+
+def vaultFiles(folder):
+    return sorted(os.path.relpath(os.path.join(root, filename), folder)
+                  for root, dirs, files in os.walk(os.path.join(folder, "_Media Vault"))
+                  for filename in files if not filename.startswith("_"))
+
+
+def crossDevice(monkeypatch, crashOnRename=False, crashOnRemove=()):
+    '''
+    Every move is copied as if it went to another file system. The process "dies" when the copy is renamed into place
+    (crashOnRename, without cleaning up after itself) or when one of the crashOnRemove sources is deleted
+    '''
+    rename, remove = os.rename, os.remove
+    def crossDeviceRename(src, dst):
+        if not str(src).endswith(TransferEngine.PARTIAL_SUFFIX):
+            raise OSError(errno.EXDEV, "Cross-device link")
+        if crashOnRename:
+            raise Crash()
+        rename(src, dst)
+    def crashingRemove(path):
+        if crashOnRename and str(path).endswith(TransferEngine.PARTIAL_SUFFIX) or path in crashOnRemove:
+            raise Crash()
+        remove(path)
+    monkeypatch.setattr(os, "rename", crossDeviceRename)
+    monkeypatch.setattr(os, "remove", crashingRemove)
+
+
+def run(resume=False):
+    MediaVault.MediaVault(workers=1, streaming=False, resume=resume).run()
+
+
+def crashingRun():
+    '''
+    Runs until Crash is raised, then lets go of the run as the process dying would: the open transactions are rolled back
+    '''
+    mediaVault = MediaVault.MediaVault(workers=1, streaming=False)
+    with pytest.raises(Crash):
+        mediaVault.run()
+    mediaVault.organizer.journal.file.close()
+    del mediaVault
+    for connection in [obj for obj in gc.get_objects() if isinstance(obj, sqlite3.Connection)]:
+        connection.close()
+
+
+def test_resume_after_a_crash_between_copy_and_source_removal(library, tmp_path, monkeypatch):
+    with monkeypatch.context() as patch:
+        crossDevice(patch, crashOnRemove={library[1]})
+        crashingRun()
+    # The copy is in the vault but its source was not deleted
+    assert os.path.exists(library[1])
+
+    run(resume=True)
+    assert not any(os.path.exists(source) for source in library)
+    assert vaultFiles(tmp_path) == [os.path.join("_Media Vault", "2021", "07", f"2021.07.08 (09h10m0{n}s).jpg") for n in range(3)]
+
+
+def test_resume_after_a_crash_before_the_copy_is_renamed(library, tmp_path, monkeypatch):
+    with monkeypatch.context() as patch:
+        crossDevice(patch, crashOnRename=True)
+        crashingRun()
+    partials = [path for path in vaultFiles(tmp_path) if path.endswith(TransferEngine.PARTIAL_SUFFIX)]
+    assert partials
+
+    run(resume=True)
+    assert not any(os.path.exists(source) for source in library)
+    assert vaultFiles(tmp_path) == [os.path.join("_Media Vault", "2021", "07", f"2021.07.08 (09h10m0{n}s).jpg") for n in range(3)]
+
+
+def test_transfer_replaces_a_stale_partial_copy(tmp_path):
+    source, target = tmp_path / "source.jpg", tmp_path / "target.jpg"
+    source.write_bytes(jpeg(datetime(2021, 7, 8)))
+    # Left behind by a run that was killed while copying
+    (tmp_path / ("target.jpg" + TransferEngine.PARTIAL_SUFFIX)).write_bytes(b"stale")
+
+    TransferEngine(1).transfer(str(source), str(target))
+    assert target.read_bytes() == jpeg(datetime(2021, 7, 8))
+    assert not source.exists()
+    assert not (tmp_path / ("target.jpg" + TransferEngine.PARTIAL_SUFFIX)).exists()
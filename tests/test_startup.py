@@ -0,0 +1,35 @@
+import os
+import py_compile
+import subprocess
+import sys
+
+import MediaVault
+
+SCRIPT = os.path.abspath(MediaVault.__file__)
+
+
+def profile(folder):
+    # Measures loading the script rather than compiling it (e.g. when PYTHONDONTWRITEBYTECODE is set)
+    py_compile.compile(SCRIPT, doraise=True)
+    child = subprocess.run([sys.executable, SCRIPT, "--revert", "--startup-profile"],
+                           cwd=folder, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    rows = {}
+    for line in child.stdout.splitlines():
+        cells = [cell.strip() for cell in line.strip("|").split("|")]
+        if len(cells) == 3 and cells[1].replace(".", "", 1).isdigit():
+            rows[cells[0]] = (float(cells[1]), float(cells[2]) if cells[2] else None)
+    return child, rows
+
+
+def test_startup_profile_is_within_the_budgets(tmp_path):
+    child, rows = profile(tmp_path)
+    assert set(MediaVault.STARTUP_PROFILE_THRESHOLDS) <= set(rows), child.stdout + child.stderr
+    for name, (milliseconds, budget) in rows.items():
+        if budget is not None:
+            assert milliseconds <= budget, f"importing {name} took {milliseconds} ms (budget: {budget} ms)"
+    assert child.returncode == 0, child.stderr
+
+
+def test_startup_profile_does_not_import_the_parsers(tmp_path):
+    child, rows = profile(tmp_path)
+    assert not {"PIL", "hachoir"} & set(rows), sorted(rows)
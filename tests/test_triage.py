@@ -0,0 +1,52 @@
+import struct
+
+import pytest
+
+from MediaVault import FileTriage
+
+
+def ftyp(brand):
+    return struct.pack('>I4s', 24, b'ftyp') + brand + b'\x00\x00\x00\x00' + b'isommp41' + b'\x00' * 64
+
+
+@pytest.mark.parametrize("filename, brand", [
+    ("clip.mp4", b'isom'), ("clip.mp4", b'mp42'), ("clip.m4v", b'M4V '), ("clip.mov", b'qt  '), ("clip.mp4", b'avc1'),
+])
+def test_video_brands_are_videos(tmp_path, filename, brand):
+    path = tmp_path / filename
+    path.write_bytes(ftyp(brand))
+    assert FileTriage.classify(str(path)) == FileTriage.Triage(FileTriage.VIDEO, 'mp4', True)
+
+
+@pytest.mark.parametrize("filename, brand", [
+    ("song.m4a", b'M4A '), ("book.m4b", b'M4B '), ("song.m4p", b'M4P '),
+    ("picture.avif", b'avif'), ("sequence.avif", b'avis'),
+    # The extension does not make them videos
+    ("song.mp4", b'M4A '), ("picture.heic", b'avif'),
+])
+def test_audio_and_avif_brands_are_unsupported(tmp_path, filename, brand):
+    path = tmp_path / filename
+    path.write_bytes(ftyp(brand))
+    assert FileTriage.classify(str(path)).kind is None
+
+
+@pytest.mark.parametrize("filename, kind", [
+    ("call.3gp", None), ("call.3g2", None), ("call.mp4", FileTriage.VIDEO),
+])
+def test_other_brands_are_trusted_by_their_extension(tmp_path, filename, kind):
+    path = tmp_path / filename
+    path.write_bytes(ftyp(b'3gp4'))
+    assert FileTriage.classify(str(path)).kind == kind
+
+
+def test_heif_brands_are_images(tmp_path):
+    path = tmp_path / "photo.heic"
+    path.write_bytes(ftyp(b'heic'))
+    assert FileTriage.classify(str(path)) == FileTriage.Triage(FileTriage.IMAGE, 'heif', True)
+
+
+@pytest.mark.parametrize("filename, kind", [("old.mov", FileTriage.VIDEO), ("song.m4a", None)])
+def test_bare_quicktime_atoms_need_a_video_extension(tmp_path, filename, kind):
+    path = tmp_path / filename
+    path.write_bytes(struct.pack('>I4s', 16, b'wide') + b'\x00' * 64)
+    assert FileTriage.classify(str(path)).kind == kind
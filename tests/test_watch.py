@@ -0,0 +1,21 @@
+import os
+from datetime import datetime
+
+from benchmark import jpeg
+from MediaVault import FileTriage, Organizer
+
+
+def test_absolute_paths_under_a_non_ascii_folder_are_ingested(tmp_path, monkeypatch):
+    folder = tmp_path / "Fotos de família"
+    folder.mkdir()
+    monkeypatch.chdir(folder)
+    (folder / "DSC0.jpg").write_bytes(jpeg(datetime(2021, 7, 8, 9, 10, 0)))
+    result = Organizer.extractCaptureDate(os.path.abspath("DSC0.jpg"))
+    assert (result.date, result.time) == ("2021.07.08", "09.10.00")
+
+
+def test_non_ascii_file_names_are_still_left_alone(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "família.jpg").write_bytes(jpeg(datetime(2021, 7, 8, 9, 10, 0)))
+    result = Organizer.extractCaptureDate(os.path.abspath("família.jpg"))
+    assert (result.date, result.file_format) == (None, FileTriage.UNSUPPORTED)